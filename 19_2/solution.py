@@ -1,7 +1,101 @@
 #!/bin/python3
 
-DEBUG = False
-DEBUG_TEST_LINE_COUNT = 2
+# count calls on the hot paths and time every phase, left off the counting wrappers never get installed -
+# library callers turn it on through enableStats()
+COLLECT_STATS = False
+# where the collected stats are written as json at the end of a run, "-" prints them instead
+STATS_FILE = "stats.json"
+# "regex" compiles the grammar into a single pattern, unrolling self recursive rules up to the longest message (within REGEX_LENGTH_LIMIT),
+# "packrat" memoizes the end offsets every rule can reach from every offset of a line,
+# "earley" runs a chart parser that copes with any rule set, left recursion included, in O(n^3) per line,
+# "batch" matches all lines of the same length together using one bit per line,
+# "graph" fans out solution candidates through the parse node objects for every line
+MATCHER = "regex"
+# the regex grows with the longest line so far as long as lines stay within this length, longer ones go to the Earley matcher
+REGEX_LENGTH_LIMIT = 256
+
+# lines are spread over this many worker processes, 1 matches everything in this process
+WORKER_COUNT = 1
+# how many lines get read and matched (or handed to a worker) at once
+CHUNK_SIZE = 2000
+# where rules and messages are read from, "-" reads them from stdin
+INPUT_FILE = "input.txt"
+# the analysed grammar and its regex are stored here as plain json, keyed by a hash of the rules and this script,
+# so the next run can load them instead of building them again - relative to this file
+CACHE_DIRECTORY = ".cache"
+USE_GRAMMAR_CACHE = True
+# only this many grammars are kept, the ones used least recently get removed first
+CACHE_ENTRY_LIMIT = 8
+
+# Overwrite rules as per problem definition!
+RULE_OVERRIDES = {
+  "8": "42 | 42 8",
+  "11": "42 31 | 42 11 31"
+}
+
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+class RunStats:
+  # counters for the hot paths and the seconds spent in every phase, only filled in when COLLECT_STATS is set
+  def __init__(self):
+    self.counters = collections.Counter()
+    self.phaseSeconds = {}
+    # (owner, method name) of every method already swapped for a counting one
+    self.wrappedMethods = set()
+
+  def countCalls(self, owner, methodName, counterName):
+    # the method is swapped for a counting one, so nothing is paid for it unless stats get collected
+    # counterName is either a fixed name or a function working out the name from the call arguments
+    if (owner, methodName) in self.wrappedMethods:
+      return
+    self.wrappedMethods.add((owner, methodName))
+    method = getattr(owner, methodName)
+    counters = self.counters
+    if callable(counterName):
+      def countingMethod(*args, **kwargs):
+        counters[counterName(*args)] += 1
+        return method(*args, **kwargs)
+    else:
+      def countingMethod(*args, **kwargs):
+        counters[counterName] += 1
+        return method(*args, **kwargs)
+    setattr(owner, methodName, countingMethod)
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    if not COLLECT_STATS:
+      yield
+      return
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.phaseSeconds[name] = self.phaseSeconds.get(name, 0) + time.perf_counter() - start
+
+  def reset(self):
+    # the counting wrappers hold on to the counter object, so it is cleared in place
+    self.counters.clear()
+    self.phaseSeconds.clear()
+
+  def toDict(self):
+    return {"counters": dict(sorted(self.counters.items())), "phaseSeconds": dict(self.phaseSeconds)}
+
+  def write(self, path):
+    statsJson = json.dumps(self.toDict(), indent=2)
+    if path == "-":
+      print(statsJson)
+      return
+    with open(path, "w") as statsFile:
+      statsFile.write(statsJson + "\n")
 
 class SolutionCandidate:
   def __init__(self, input, ruleStack):
@@ -12,6 +106,11 @@ class GrammarParseNode:
   def __init__(self, line):
     self.line = line.strip()
     self.parseGraph = self.buildParseGraph()
+    # filled in by GrammarAnalysis for options, None means the node could start with anything
+    self.firstCharacters = None
+
+  def canStartAt(self, input, offset):
+    return self.firstCharacters is None or input[offset:offset+1] in self.firstCharacters
 
   def buildParseGraph(self):
     raise NotImplementedError()
@@ -41,23 +140,36 @@ class LiteralParseNode(GrammarParseNode):
 
   def tryMatch(self, input, ruleStack, ruleDictionary):
     processedInput = input
-    if DEBUG:
-      print(f"attempt to match '{self.line}' into '{processedInput}'")
     doesMatch = processedInput.startswith(self.line)
 
     # if there is a match, consume input
     if doesMatch:
-      if DEBUG:
-        print(f"matched literal '{self.line}'")
       processedInput = processedInput.replace(self.line, "", 1)
 
-    if DEBUG and doesMatch:
-      print(f"return new token stream: '{processedInput}'")
-
     # if a token got processed we reset the rule Stack - literally any rule can try to consume the next token now
     newSolutionCandidate = SolutionCandidate(processedInput, [] if doesMatch else ruleStack)
     return (doesMatch, newSolutionCandidate)
 
+  def buildPattern(self, ruleDictionary, patternCache, maxInputLength):
+    return re.escape(self.line)
+
+  def matchEnds(self, input, offset, ruleDictionary, memo):
+    if input.startswith(self.line, offset):
+      return {offset + len(self.line)}
+    return set()
+
+  def matchSpans(self, batch, offset, ruleDictionary, memo):
+    if offset + len(self.line) > batch.lineLength:
+      return {}
+    # the lines carrying this literal at the offset are the ones carrying each of its characters at the right spot
+    lineMask = batch.allLinesMask
+    for characterIndex, character in enumerate(self.line):
+      lineMask &= batch.characterMasks[offset + characterIndex].get(character, 0)
+    return {offset + len(self.line): lineMask} if lineMask else {}
+
+  def referencesRule(self, ruleName):
+    return False
+
 class RuleReferenceParseNode(GrammarParseNode):
   def buildParseGraph(self):
     return None
@@ -71,12 +183,22 @@ class RuleReferenceParseNode(GrammarParseNode):
 
     ruleStack.append(self.line)
 
-    # if DEBUG:
-    #   print(f"reference rule {self.line} for further parsing")
     (doesMatch, newSolutionCandidates) = ruleToMatch.tryMatch(input, ruleStack, ruleDictionary)
 
     return (doesMatch, newSolutionCandidates)
 
+  def buildPattern(self, ruleDictionary, patternCache, maxInputLength):
+    return ruleDictionary[self.line].buildPattern(ruleDictionary, patternCache, maxInputLength)
+
+  def matchEnds(self, input, offset, ruleDictionary, memo):
+    return ruleDictionary[self.line].matchEnds(input, offset, ruleDictionary, memo)
+
+  def matchSpans(self, batch, offset, ruleDictionary, memo):
+    return ruleDictionary[self.line].matchSpans(batch, offset, ruleDictionary, memo)
+
+  def referencesRule(self, ruleName):
+    return self.line == ruleName
+
 class SequentialParseNode(GrammarParseNode):
   def buildParseGraph(self):
     sequenceNodes = []
@@ -91,8 +213,6 @@ class SequentialParseNode(GrammarParseNode):
   def tryMatch(self, input, ruleStack, ruleDictionary):
     processedInput = input
 
-    if DEBUG:
-      print(f"matching sequence '{self.line}' with input '{input}'")
     currentSolutionCandidate = SolutionCandidate(input, ruleStack.copy())
     for parseNodeToMatch in self.parseGraph:
       (doesMatch, currentSolutionCandidate) = parseNodeToMatch.tryMatchWrapper(currentSolutionCandidate, ruleDictionary)
@@ -102,6 +222,43 @@ class SequentialParseNode(GrammarParseNode):
 
     return (doesMatch, currentSolutionCandidate if doesMatch else SolutionCandidate(input, ruleStack))
 
+  def buildPattern(self, ruleDictionary, patternCache, maxInputLength):
+    return "".join(parseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for parseNode in self.parseGraph)
+
+  def matchEnds(self, input, offset, ruleDictionary, memo):
+    # carry along every offset the sequence could have reached so far instead of committing to one of them
+    offsets = {offset}
+    for parseNode in self.parseGraph:
+      nextOffsets = set()
+      for currentOffset in offsets:
+        nextOffsets.update(parseNode.matchEnds(input, currentOffset, ruleDictionary, memo))
+      offsets = nextOffsets
+      if not offsets:
+        break
+    return offsets
+
+  def matchSpans(self, batch, offset, ruleDictionary, memo):
+    spans = {offset: batch.allLinesMask}
+    for parseNode in self.parseGraph:
+      nextSpans = {}
+      for currentOffset, lineMask in spans.items():
+        for endOffset, endLineMask in parseNode.matchSpans(batch, currentOffset, ruleDictionary, memo).items():
+          # only lines that got this far and also match the next node go on
+          combinedLineMask = lineMask & endLineMask
+          if combinedLineMask:
+            nextSpans[endOffset] = nextSpans.get(endOffset, 0) | combinedLineMask
+      spans = nextSpans
+      if not spans:
+        break
+    return spans
+
+  def referencesRule(self, ruleName):
+    return any(parseNode.referencesRule(ruleName) for parseNode in self.parseGraph)
+
+  # how much input one more level of recursion into the given rule consumes at the very least
+  def recursionStepLength(self, ruleName, ruleDictionary):
+    return sum(len(parseNode.line) if type(parseNode) == LiteralParseNode else ruleDictionary[parseNode.line].lengthRange[0] for parseNode in self.parseGraph if not parseNode.referencesRule(ruleName))
+
 class OptionParseNode(GrammarParseNode):
   def buildParseGraph(self):
     optionNodes = []
@@ -116,12 +273,13 @@ class OptionParseNode(GrammarParseNode):
     # we also have to make sure we're avoiding loops by keeping track of what rules are being already applied on the current token
     potentialMatches = []
     for optionParseNode in self.parseGraph:
+      # options that can't start with the next character would fail anyway
+      if not optionParseNode.canStartAt(input, 0):
+        continue
       currentSolutionCandidate = SolutionCandidate(input, ruleStack.copy())
       (doesMatch, newSolutioncandidate) = optionParseNode.tryMatchWrapper(currentSolutionCandidate, ruleDictionary)
 
       if doesMatch:
-        # if DEBUG:
-        #   print(f"option '{optionParseNode.line}' has found matches")
         if type(newSolutioncandidate) == list:
           potentialMatches.extend(newSolutioncandidate)
         else:
@@ -130,65 +288,695 @@ class OptionParseNode(GrammarParseNode):
     doesMatch = len(potentialMatches) > 0
     return (doesMatch, potentialMatches if doesMatch else [SolutionCandidate(input, ruleStack)])
 
+  def buildPattern(self, ruleDictionary, patternCache, maxInputLength):
+    return self.joinOptionPatterns([optionParseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for optionParseNode in self.parseGraph])
+
+  def joinOptionPatterns(self, optionPatterns):
+    if len(optionPatterns) == 1:
+      return optionPatterns[0]
+    return "(?:" + "|".join(optionPatterns) + ")"
+
+  def matchEnds(self, input, offset, ruleDictionary, memo):
+    offsets = set()
+    for optionParseNode in self.parseGraph:
+      if optionParseNode.canStartAt(input, offset):
+        offsets.update(optionParseNode.matchEnds(input, offset, ruleDictionary, memo))
+    return offsets
+
+  def matchSpans(self, batch, offset, ruleDictionary, memo):
+    spans = {}
+    for optionParseNode in self.parseGraph:
+      for endOffset, lineMask in optionParseNode.matchSpans(batch, offset, ruleDictionary, memo).items():
+        spans[endOffset] = spans.get(endOffset, 0) | lineMask
+    return spans
+
 
 class GrammarRule:
   def __init__(self, name, line):
     self.name = name
     self.line = line
     self.parseGraph = self.buildParseGraph()
+    # (shortest, longest) input the rule can match, filled in by GrammarAnalysis
+    self.lengthRange = None
+    # whether the rule can reach itself again before consuming anything, until GrammarAnalysis says otherwise it might
+    self.isLeftRecursive = True
+
+  def acceptsLength(self, inputLength):
+    return self.lengthRange is None or self.lengthRange[0] <= inputLength <= self.lengthRange[1]
 
   def buildParseGraph(self):
     return OptionParseNode(self.line)
 
   def tryMatch(self, input, ruleStack, ruleDictionary):
-    # if DEBUG:
-    #   print(f"matching grammar rule {self.name} with input '{input}'")
     return self.parseGraph.tryMatchWrapper(SolutionCandidate(input, ruleStack), ruleDictionary)
 
-f = open("input.txt", "r")
-line = f.readline()
-grammarLines = []
-while line.strip() != "":
-  grammarLines.append(line)
-  line = f.readline()
-
-line = f.readline()
-testLines = []
-while line:
-  testLines.append(line.strip())
-  line = f.readline()
-
-grammarDictionary = {}
-for grammarLine in grammarLines:
-  splitLine = grammarLine.split(": ")
-  ruleName = splitLine[0]
-  ruleDefinition = splitLine[1]
-  grammarDictionary[ruleName] = GrammarRule(ruleName, ruleDefinition)
-
-# Overwrite rules as per problem definition!
-grammarDictionary["8"] = GrammarRule("8", "42 | 42 8")
-grammarDictionary["11"] = GrammarRule("11", "42 31 | 42 11 31")
-
-count = 0
-debugTestLineCounter = 1
-for testLine in testLines:
-  if DEBUG:
-    print(f"line to test: {testLine}")
-
-  (doesMatch, solutionCandidates) = grammarDictionary["0"].tryMatch(testLine, ["0"], grammarDictionary)
+  def recursionShape(self):
+    # None for a rule not referring to itself, "leading" or "trailing" when it only ever does at the start (or the end)
+    # of its options, "nested" for a single reference in the middle of one option and "branching" for more than one
+    selfReferences = [
+      [parseNode.referencesRule(self.name) for parseNode in optionParseNode.parseGraph]
+      for optionParseNode in self.parseGraph.parseGraph if optionParseNode.referencesRule(self.name)
+    ]
+    if len(selfReferences) == 0:
+      return None
+    if all(references[0] and not any(references[1:]) for references in selfReferences):
+      return "leading"
+    if all(references[-1] and not any(references[:-1]) for references in selfReferences):
+      return "trailing"
+    if sum(sum(references) for references in selfReferences) > 1:
+      return "branching"
+    return "nested"
+
+  def buildPattern(self, ruleDictionary, patternCache, maxInputLength):
+    if self.name in patternCache:
+      if patternCache[self.name] is None:
+        # only direct self references can be unrolled, rules referencing each other in a loop can't -
+        # the rules still being expanded sit in the cache in the order they were entered, from this one on they are the loop
+        activeRules = [ruleName for ruleName, pattern in patternCache.items() if pattern is None]
+        loop = activeRules[activeRules.index(self.name):] + [self.name]
+        raise ValueError(f"rule {self.name} is mutually recursive through {' -> '.join(loop)}, it can't be turned into a regular expression")
+      return patternCache[self.name]
+    patternCache[self.name] = None
+
+    recursionShape = self.recursionShape()
+    if recursionShape is None:
+      pattern = self.parseGraph.buildPattern(ruleDictionary, patternCache, maxInputLength)
+      # when every match of the rule is equally long the rest of the line looks the same whichever option matched,
+      # an atomic group keeps the regex engine from trying all the other options again each time something later fails
+      if len(self.parseGraph.parseGraph) > 1 and self.lengthRange is not None and self.lengthRange[0] == self.lengthRange[1] and sys.version_info >= (3, 11):
+        pattern = f"(?>{pattern})"
+      patternCache[self.name] = pattern
+      return patternCache[self.name]
+
+    # compile every other rule this one depends on first, so they never see a partially unrolled version of this rule
+    for optionParseNode in self.parseGraph.parseGraph:
+      for parseNode in optionParseNode.parseGraph:
+        if not parseNode.referencesRule(self.name):
+          parseNode.buildPattern(ruleDictionary, patternCache, maxInputLength)
+
+    baseOptions = [optionParseNode for optionParseNode in self.parseGraph.parseGraph if not optionParseNode.referencesRule(self.name)]
+    recursiveOptions = [optionParseNode for optionParseNode in self.parseGraph.parseGraph if optionParseNode.referencesRule(self.name)]
+    if len(baseOptions) == 0:
+      raise ValueError(f"rule {self.name} refers to itself in every option, there's nothing to end its recursion")
+
+    # every level of recursion eats some input, so no message can ever need more levels than its length allows
+    stepLength = min(optionParseNode.recursionStepLength(self.name, ruleDictionary) for optionParseNode in recursiveOptions)
+    if stepLength == 0:
+      raise ValueError(f"rule {self.name} refers to itself without consuming any input")
+    # a step that can never match (it goes through a rule without any finite match) is never worth unrolling
+    unrollDepth = maxInputLength // stepLength if stepLength != math.inf else 0
+
+    basePatterns = [optionParseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for optionParseNode in baseOptions]
+    patternCache[self.name] = self.parseGraph.joinOptionPatterns(basePatterns)
+
+    # referring to itself only at the start (or only at the end) of its options the rule just repeats the rest of them,
+    # a star says that without the nested levels of an unrolled pattern the regex engine would backtrack through
+    if recursionShape == "leading":
+      tailPatterns = ["".join(parseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for parseNode in optionParseNode.parseGraph[1:]) for optionParseNode in recursiveOptions]
+      patternCache[self.name] = patternCache[self.name] + "(?:" + "|".join(tailPatterns) + ")*"
+      return patternCache[self.name]
+    if recursionShape == "trailing":
+      headPatterns = ["".join(parseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for parseNode in optionParseNode.parseGraph[:-1]) for optionParseNode in recursiveOptions]
+      patternCache[self.name] = "(?:" + "|".join(headPatterns) + ")*" + patternCache[self.name]
+      return patternCache[self.name]
+    if recursionShape == "branching":
+      # every unrolled level would hold the previous one several times over, the pattern doubles in size per level
+      raise ValueError(f"rule {self.name} refers to itself more than once in its options, unrolling it would blow up the pattern")
+
+    # a single option with the rule in its middle reads its prefix n times, a base option and its suffix n times -
+    # regular expressions can't count, so every depth is an alternative of its own, flat rather than nested into the last one
+    recursiveNodes = recursiveOptions[0].parseGraph
+    referenceIndex = [parseNode.referencesRule(self.name) for parseNode in recursiveNodes].index(True)
+    prefixPattern = "".join(parseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for parseNode in recursiveNodes[:referenceIndex])
+    suffixPattern = "".join(parseNode.buildPattern(ruleDictionary, patternCache, maxInputLength) for parseNode in recursiveNodes[referenceIndex + 1:])
+    basePattern = patternCache[self.name]
+    depthPatterns = [basePattern] + [f"(?:{prefixPattern}){{{depth}}}{basePattern}(?:{suffixPattern}){{{depth}}}" for depth in range(1, unrollDepth + 1)]
+    patternCache[self.name] = self.parseGraph.joinOptionPatterns(depthPatterns)
+    return patternCache[self.name]
+
+  def matchEnds(self, input, offset, ruleDictionary, memo):
+    memoKey = (self.name, offset)
+    if memoKey in memo.results:
+      return memo.results[memoKey]
+    if not self.isLeftRecursive:
+      # every path back to this rule consumes input first, so it can't run into its own unfinished result
+      memo.results[memoKey] = frozenset(self.parseGraph.matchEnds(input, offset, ruleDictionary, memo))
+      return memo.results[memoKey]
+    # a left recursive rule reaches itself again at the same offset, the memo grows its ends round by round
+    return memo.grow(memoKey, frozenset(), lambda: frozenset(self.parseGraph.matchEnds(input, offset, ruleDictionary, memo)))
+
+  def matchSpans(self, batch, offset, ruleDictionary, memo):
+    memoKey = (self.name, offset)
+    if memoKey in memo.results:
+      return memo.results[memoKey]
+    if not self.isLeftRecursive:
+      memo.results[memoKey] = self.parseGraph.matchSpans(batch, offset, ruleDictionary, memo)
+      return memo.results[memoKey]
+    # same as matchEnds, the spans of a left recursive rule grow until a round adds no end and no line
+    return memo.grow(memoKey, {}, lambda: self.parseGraph.matchSpans(batch, offset, ruleDictionary, memo))
+
+class GrammarAnalysis:
+  def __init__(self, ruleDictionary):
+    self.ruleDictionary = ruleDictionary
+    self.firstCharacters = self.computeFirstCharacters()
+    self.minimumLengths = self.computeMinimumLengths()
+    self.leftRecursiveRules = self.computeLeftRecursiveRules()
+    self.maximumLengths = {}
+    for ruleName in self.ruleDictionary:
+      self.computeMaximumLength(ruleName, set())
+
+  def options(self, ruleName):
+    return self.ruleDictionary[ruleName].parseGraph.parseGraph
+
+  def nodeFirstCharacters(self, parseNode):
+    if type(parseNode) == LiteralParseNode:
+      return {parseNode.line[:1]}
+    return self.firstCharacters[parseNode.line]
+
+  def nodeMinimumLength(self, parseNode):
+    if type(parseNode) == LiteralParseNode:
+      return len(parseNode.line)
+    return self.minimumLengths[parseNode.line]
+
+  def computeFirstCharacters(self):
+    # every option consumes input, so only its first node decides what it can start with -
+    # the sets keep growing until nothing changes, which also gets us through recursive rules
+    self.firstCharacters = {ruleName: set() for ruleName in self.ruleDictionary}
+    changed = True
+    while changed:
+      changed = False
+      for ruleName in self.ruleDictionary:
+        for optionParseNode in self.options(ruleName):
+          characters = self.nodeFirstCharacters(optionParseNode.parseGraph[0])
+          if not characters <= self.firstCharacters[ruleName]:
+            self.firstCharacters[ruleName] |= characters
+            changed = True
+    return self.firstCharacters
+
+  def computeMinimumLengths(self):
+    self.minimumLengths = {ruleName: math.inf for ruleName in self.ruleDictionary}
+    changed = True
+    while changed:
+      changed = False
+      for ruleName in self.ruleDictionary:
+        for optionParseNode in self.options(ruleName):
+          length = sum(self.nodeMinimumLength(parseNode) for parseNode in optionParseNode.parseGraph)
+          if length < self.minimumLengths[ruleName]:
+            self.minimumLengths[ruleName] = length
+            changed = True
+    return self.minimumLengths
+
+  def computeLeftRecursiveRules(self):
+    # rules reaching themselves again through the first node of an option, before any input got consumed
+    leftReferences = {
+      ruleName: {optionParseNode.parseGraph[0].line for optionParseNode in self.options(ruleName) if type(optionParseNode.parseGraph[0]) != LiteralParseNode}
+      for ruleName in self.ruleDictionary
+    }
+    leftRecursiveRules = set()
+    for ruleName in self.ruleDictionary:
+      reachableRules = set()
+      pendingRules = list(leftReferences[ruleName])
+      while pendingRules:
+        referencedRuleName = pendingRules.pop()
+        if referencedRuleName not in reachableRules:
+          reachableRules.add(referencedRuleName)
+          pendingRules.extend(leftReferences[referencedRuleName])
+      if ruleName in reachableRules:
+        leftRecursiveRules.add(ruleName)
+    return leftRecursiveRules
+
+  def computeMaximumLength(self, ruleName, activeRules):
+    if ruleName in self.maximumLengths:
+      return self.maximumLengths[ruleName]
+    # every trip around a loop of rules consumes input, so a recursive rule has no upper bound
+    if ruleName in activeRules:
+      return math.inf
+    activeRules.add(ruleName)
+    longest = 0
+    for optionParseNode in self.options(ruleName):
+      length = 0
+      for parseNode in optionParseNode.parseGraph:
+        if type(parseNode) == LiteralParseNode:
+          length += len(parseNode.line)
+        else:
+          length += self.computeMaximumLength(parseNode.line, activeRules)
+      longest = max(longest, length)
+    activeRules.discard(ruleName)
+    self.maximumLengths[ruleName] = longest
+    return longest
+
+  def annotate(self):
+    for ruleName, rule in self.ruleDictionary.items():
+      rule.lengthRange = (self.minimumLengths[ruleName], self.maximumLengths[ruleName])
+      rule.isLeftRecursive = ruleName in self.leftRecursiveRules
+      for optionParseNode in self.options(ruleName):
+        optionParseNode.firstCharacters = self.nodeFirstCharacters(optionParseNode.parseGraph[0])
+
+class GrowingMemo:
+  # memo for the packrat and batch matchers that copes with left recursion: a left recursive rule reached again at the same offset
+  # before it finished gets what it matched so far, and it is evaluated again until another round doesn't add anything
+  def __init__(self):
+    self.results = {}
+    # memo key -> (depth on the evaluation stack, result so far) for every rule still being evaluated
+    self.growing = {}
+    # the shallowest unfinished rule the running evaluation read from, results depending on one aren't final yet
+    self.shallowestDependency = math.inf
+
+  def grow(self, memoKey, seed, evaluate):
+    if memoKey in self.growing:
+      (depth, result) = self.growing[memoKey]
+      self.shallowestDependency = min(self.shallowestDependency, depth)
+      return result
+
+    depth = len(self.growing)
+    outerDependency = self.shallowestDependency
+    result = seed
+    while True:
+      self.growing[memoKey] = (depth, result)
+      self.shallowestDependency = math.inf
+      grownResult = evaluate()
+      # matching only ever adds to a result when its seed grows, so this stops once a round changes nothing
+      if self.shallowestDependency > depth or grownResult == result:
+        break
+      result = grownResult
+    del self.growing[memoKey]
+
+    if self.shallowestDependency >= depth:
+      # nothing but this rule's own earlier rounds went into the result, so it is final
+      self.results[memoKey] = grownResult
+      self.shallowestDependency = outerDependency
+    else:
+      # a rule further out is still growing, this one gets evaluated again in its next round
+      self.shallowestDependency = min(outerDependency, self.shallowestDependency)
+    return grownResult
+
+class PackratMatcher:
+  def __init__(self, ruleDictionary, startRuleName):
+    self.ruleDictionary = ruleDictionary
+    self.startRule = ruleDictionary[startRuleName]
+
+  def matches(self, input):
+    # the memo only holds offsets into this one line, so it starts out empty for every line
+    if not self.startRule.acceptsLength(len(input)):
+      return False
+    memo = GrowingMemo()
+    return len(input) in self.startRule.matchEnds(input, 0, self.ruleDictionary, memo)
+
+class EarleyMatcher:
+  def __init__(self, ruleDictionary, startRuleName):
+    self.startRuleName = startRuleName
+    # flatten the parse graph into plain productions: for every rule a list of options,
+    # every option a tuple of (isLiteral, literal or referenced rule name) symbols
+    self.productions = {}
+    for ruleName, rule in ruleDictionary.items():
+      self.productions[ruleName] = [
+        tuple((type(parseNode) == LiteralParseNode, parseNode.line) for parseNode in optionParseNode.parseGraph)
+        for optionParseNode in rule.parseGraph.parseGraph
+      ]
+
+  def matches(self, input):
+    inputLength = len(input)
+    # an item is (rule name, option index, symbols matched so far, offset the item was predicted at)
+    chart = [[] for _ in range(inputLength + 1)]
+    chartItems = [set() for _ in range(inputLength + 1)]
+    # per offset, the items whose next symbol is a reference to a given rule - they advance once that rule completes
+    waitingItems = [{} for _ in range(inputLength + 1)]
+
+    def addItem(offset, item):
+      if item in chartItems[offset]:
+        return
+      chartItems[offset].add(item)
+      chart[offset].append(item)
+
+    for optionIndex in range(len(self.productions[self.startRuleName])):
+      addItem(0, (self.startRuleName, optionIndex, 0, 0))
+
+    for offset in range(inputLength + 1):
+      items = chart[offset]
+      completedRules = set()
+      i = 0
+      while i < len(items):
+        (ruleName, optionIndex, dot, origin) = items[i]
+        i += 1
+        symbols = self.productions[ruleName][optionIndex]
+
+        # completion: the rule is done, move on every item that was waiting for it
+        if dot == len(symbols):
+          if origin == offset:
+            completedRules.add(ruleName)
+          for (waitingRuleName, waitingOptionIndex, waitingDot, waitingOrigin) in waitingItems[origin].get(ruleName, []):
+            addItem(offset, (waitingRuleName, waitingOptionIndex, waitingDot + 1, waitingOrigin))
+          continue
+
+        (isLiteral, value) = symbols[dot]
+        # scanning: a literal consumes input and moves the item into a later chart column
+        if isLiteral:
+          if input.startswith(value, offset):
+            addItem(offset + len(value), (ruleName, optionIndex, dot + 1, origin))
+          continue
+
+        # prediction: start every option of the referenced rule at this offset
+        waitingItems[offset].setdefault(value, []).append((ruleName, optionIndex, dot, origin))
+        for predictedOptionIndex in range(len(self.productions[value])):
+          addItem(offset, (value, predictedOptionIndex, 0, offset))
+        # the referenced rule may already have completed without consuming anything at this offset
+        if value in completedRules:
+          addItem(offset, (ruleName, optionIndex, dot + 1, origin))
+
+    for (ruleName, optionIndex, dot, origin) in chart[inputLength]:
+      if ruleName == self.startRuleName and origin == 0 and dot == len(self.productions[ruleName][optionIndex]):
+        return True
+    return False
+
+class LineBatch:
+  def __init__(self, lines):
+    # every line of the batch has the same length and owns one bit in every mask
+    self.lineLength = len(lines[0])
+    self.allLinesMask = (1 << len(lines)) - 1
+    # for every offset, which lines carry which character there
+    self.characterMasks = [{} for _ in range(self.lineLength)]
+    for lineIndex, line in enumerate(lines):
+      lineBit = 1 << lineIndex
+      for offset, character in enumerate(line):
+        self.characterMasks[offset][character] = self.characterMasks[offset].get(character, 0) | lineBit
+
+class BatchMatcher:
+  def __init__(self, ruleDictionary, startRuleName):
+    self.ruleDictionary = ruleDictionary
+    self.startRule = ruleDictionary[startRuleName]
+
+  def matchAll(self, lines):
+    # lines of equal length share every span of the input, so they are grouped and matched as one bit set
+    lineIndicesByLength = {}
+    for lineIndex, line in enumerate(lines):
+      lineIndicesByLength.setdefault(len(line), []).append(lineIndex)
+
+    results = [False] * len(lines)
+    for lineLength, lineIndices in lineIndicesByLength.items():
+      if not self.startRule.acceptsLength(lineLength):
+        continue
+      batch = LineBatch([lines[lineIndex] for lineIndex in lineIndices])
+      memo = GrowingMemo()
+      matchedLineMask = self.startRule.matchSpans(batch, 0, self.ruleDictionary, memo).get(lineLength, 0)
+      for bitIndex, lineIndex in enumerate(lineIndices):
+        results[lineIndex] = (matchedLineMask >> bitIndex) & 1 == 1
+    return results
+
+  def matches(self, input):
+    return self.matchAll([input])[0]
+
+class CompiledGrammar:
+  def __init__(self, ruleDictionary, startRuleName, maxInputLength=64, patternSource=None):
+    self.ruleDictionary = ruleDictionary
+    self.startRuleName = startRuleName
+    # only rules unrolled level by level tie the pattern to a line length, any other pattern takes lines of every length
+    self.isLengthBound = any(rule.recursionShape() == "nested" for rule in ruleDictionary.values())
+    # cleared once a bigger pattern failed to compile, there's no point building it again for every long line
+    self.canGrow = True
+    # built the first time a line is too long for the pattern
+    self.longLineMatcher = None
+    # set by loadGrammar, a pattern grown for longer lines replaces the one in the cache so the next run starts out grown
+    self.cachePath = None
+    self.compile(maxInputLength, patternSource)
+
+  def compile(self, maxInputLength, patternSource=None):
+    # the whole grammar collapses into a single pattern, so a line is checked in one pass of the regex engine
+    if patternSource is None:
+      patternSource = self.ruleDictionary[self.startRuleName].buildPattern(self.ruleDictionary, {}, maxInputLength)
+    # nothing is replaced before the new pattern compiled, a failed attempt leaves the old one in place
+    self.pattern = re.compile(patternSource)
+    self.patternSource = patternSource
+    self.maxInputLength = maxInputLength
+
+  def matches(self, input):
+    if self.isLengthBound and len(input) > self.maxInputLength:
+      # lines arrive one at a time, so recursive rules get unrolled further whenever a line outgrows the pattern
+      if self.canGrow and self.maxInputLength < REGEX_LENGTH_LIMIT:
+        try:
+          self.compile(min(max(len(input), 2 * self.maxInputLength), REGEX_LENGTH_LIMIT))
+          if self.cachePath is not None:
+            writeCacheEntry(self.cachePath, grammarToTables(self.ruleDictionary, self))
+        except (re.error, RecursionError, MemoryError):
+          # the regex engine gave up on the bigger pattern, lines it can't take go the same way as lines past the limit
+          self.canGrow = False
+      if len(input) > self.maxInputLength:
+        # the pattern grows with every level a longer line could need, past the limit parsing the line costs less
+        if self.longLineMatcher is None:
+          self.longLineMatcher = EarleyMatcher(self.ruleDictionary, self.startRuleName)
+        return self.longLineMatcher.matches(input)
+    return self.pattern.fullmatch(input) is not None
+
+def matchWithParseGraph(input, ruleDictionary):
+  if not ruleDictionary["0"].acceptsLength(len(input)):
+    return False
+  (doesMatch, solutionCandidates) = ruleDictionary["0"].tryMatch(input, ["0"], ruleDictionary)
   # if it matches and all input was processed we have a hit
   if doesMatch:
     for candidate in solutionCandidates:
       if len(candidate.input) == 0:
-        print(f"matched line {testLine}")
-        count += 1
-        break
-  
-  if DEBUG:
-    print("==================")
-
-  if DEBUG and debugTestLineCounter == DEBUG_TEST_LINE_COUNT:
-    break
-  debugTestLineCounter += 1
-
-print(count)
+        return True
+  return False
+
+def buildGrammarDictionary(grammarLines):
+  grammarDictionary = {}
+  for grammarLine in grammarLines:
+    splitLine = grammarLine.split(": ")
+    ruleName = splitLine[0]
+    ruleDefinition = splitLine[1]
+    grammarDictionary[ruleName] = GrammarRule(ruleName, ruleDefinition)
+
+  for ruleName, ruleDefinition in RULE_OVERRIDES.items():
+    grammarDictionary[ruleName] = GrammarRule(ruleName, ruleDefinition)
+
+  GrammarAnalysis(grammarDictionary).annotate()
+  return grammarDictionary
+
+def buildMatcher(grammarDictionary, compiledPattern=None):
+  if MATCHER == "regex":
+    if compiledPattern is not None:
+      return CompiledGrammar(grammarDictionary, "0", compiledPattern["maxInputLength"], compiledPattern["source"])
+    try:
+      return CompiledGrammar(grammarDictionary, "0")
+    except ValueError as error:
+      # the pattern only unrolls rules referring to themselves, the packrat matcher takes any grammar
+      print(f"{error}, falling back to the packrat matcher", file=sys.stderr)
+      return PackratMatcher(grammarDictionary, "0")
+  if MATCHER == "packrat":
+    return PackratMatcher(grammarDictionary, "0")
+  if MATCHER == "batch":
+    return BatchMatcher(grammarDictionary, "0")
+  if MATCHER == "earley":
+    return EarleyMatcher(grammarDictionary, "0")
+  return None
+
+def matchLines(lines, grammarDictionary, compiledGrammar):
+  # the batch matcher wants to see all lines at once rather than one at a time
+  if MATCHER == "batch":
+    results = compiledGrammar.matchAll(lines)
+  elif compiledGrammar is not None:
+    results = [compiledGrammar.matches(line) for line in lines]
+  else:
+    results = [matchWithParseGraph(line, grammarDictionary) for line in lines]
+  return results
+
+def grammarCacheKey(grammarLines):
+  hash = hashlib.sha256()
+  # tables built by an older version of this script must not be picked up
+  with open(__file__, "rb") as sourceFile:
+    hash.update(sourceFile.read())
+  hash.update(f"matcher {MATCHER}\n".encode())
+  for grammarLine in grammarLines:
+    hash.update(f"{grammarLine.strip()}\n".encode())
+  for ruleName in sorted(RULE_OVERRIDES):
+    hash.update(f"override {ruleName}: {RULE_OVERRIDES[ruleName]}\n".encode())
+  return hash.hexdigest()
+
+def getCacheDirectory():
+  # next to this file rather than wherever the script happens to be started from
+  return os.path.join(os.path.dirname(os.path.abspath(__file__)), CACHE_DIRECTORY)
+
+def grammarToTables(grammarDictionary, compiledGrammar):
+  # only plain data goes into the cache, loading it rebuilds the rules and the matcher instead of unpickling them
+  tables = {
+    "rules": {ruleName: rule.line for ruleName, rule in grammarDictionary.items()},
+    "lengthRanges": {ruleName: list(rule.lengthRange) for ruleName, rule in grammarDictionary.items()},
+    "leftRecursiveRules": sorted(ruleName for ruleName, rule in grammarDictionary.items() if rule.isLeftRecursive),
+    "firstCharacters": {
+      ruleName: [sorted(optionParseNode.firstCharacters) for optionParseNode in rule.parseGraph.parseGraph]
+      for ruleName, rule in grammarDictionary.items()
+    }
+  }
+  if type(compiledGrammar) == CompiledGrammar:
+    tables["pattern"] = {"source": compiledGrammar.patternSource, "maxInputLength": compiledGrammar.maxInputLength}
+  return tables
+
+def grammarFromTables(tables):
+  # the analysis results are put back onto fresh rules, so GrammarAnalysis doesn't have to run again
+  grammarDictionary = {}
+  for ruleName, ruleDefinition in tables["rules"].items():
+    rule = GrammarRule(ruleName, ruleDefinition)
+    rule.lengthRange = tuple(tables["lengthRanges"][ruleName])
+    rule.isLeftRecursive = ruleName in tables["leftRecursiveRules"]
+    for optionParseNode, firstCharacters in zip(rule.parseGraph.parseGraph, tables["firstCharacters"][ruleName]):
+      optionParseNode.firstCharacters = set(firstCharacters)
+    grammarDictionary[ruleName] = rule
+  return (grammarDictionary, buildMatcher(grammarDictionary, tables.get("pattern")))
+
+def evictCacheEntries(cacheDirectory):
+  entryTimes = {}
+  for entryName in os.listdir(cacheDirectory):
+    if entryName.startswith("grammar-") and entryName.endswith((".json", ".pickle")):
+      # another process may have evicted the entry in the meantime
+      with contextlib.suppress(OSError):
+        entryTimes[entryName] = os.path.getmtime(os.path.join(cacheDirectory, entryName))
+  for entryName in sorted(entryTimes, key=entryTimes.get, reverse=True)[CACHE_ENTRY_LIMIT:]:
+    with contextlib.suppress(OSError):
+      os.remove(os.path.join(cacheDirectory, entryName))
+
+def writeCacheEntry(cachePath, tables):
+  # write to a private file first, workers starting up together may be loading the same cache entry
+  temporaryPath = f"{cachePath}.{os.getpid()}"
+  try:
+    os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+    with open(temporaryPath, "w") as cacheFile:
+      json.dump(tables, cacheFile)
+    os.replace(temporaryPath, cachePath)
+    evictCacheEntries(os.path.dirname(cachePath))
+  except OSError:
+    # a directory that can't be written to only costs the next run its head start
+    with contextlib.suppress(OSError):
+      os.remove(temporaryPath)
+
+def loadGrammar(grammarLines):
+  if not USE_GRAMMAR_CACHE:
+    grammarDictionary = buildGrammarDictionary(grammarLines)
+    return (grammarDictionary, buildMatcher(grammarDictionary))
+
+  cacheDirectory = getCacheDirectory()
+  cachePath = os.path.join(cacheDirectory, f"grammar-{grammarCacheKey(grammarLines)}.json")
+  try:
+    with open(cachePath, "r") as cacheFile:
+      loadedGrammar = grammarFromTables(json.load(cacheFile))
+    if type(loadedGrammar[1]) == CompiledGrammar:
+      loadedGrammar[1].cachePath = cachePath
+    # a hit counts as a use, so grammars still in use aren't the ones getting evicted - unless the cache can't be written to
+    with contextlib.suppress(OSError):
+      os.utime(cachePath)
+    return loadedGrammar
+  except Exception:
+    # missing, damaged or written in some other shape, an entry that doesn't load is built again
+    pass
+
+  grammarDictionary = buildGrammarDictionary(grammarLines)
+  compiledGrammar = buildMatcher(grammarDictionary)
+  writeCacheEntry(cachePath, grammarToTables(grammarDictionary, compiledGrammar))
+  if type(compiledGrammar) == CompiledGrammar:
+    compiledGrammar.cachePath = cachePath
+  return (grammarDictionary, compiledGrammar)
+
+# every worker process builds its own grammar once and then only receives chunks of lines
+workerGrammarDictionary = None
+workerCompiledGrammar = None
+
+def initializeWorker(grammarLines, collectStats):
+  global workerGrammarDictionary, workerCompiledGrammar
+  # a spawned worker starts from a fresh import of this file, the parent's wrappers have to be put in again,
+  # a forked one starts with a copy of the parent's counts, which the parent already has
+  if collectStats:
+    enableStats()
+    stats.reset()
+  (workerGrammarDictionary, workerCompiledGrammar) = loadGrammar(grammarLines)
+
+def matchLinesInWorker(lines):
+  # the counts of a chunk go back along with its results, the parent adds them to its own
+  results = matchLines(lines, workerGrammarDictionary, workerCompiledGrammar)
+  chunkCounters = dict(stats.counters)
+  stats.counters.clear()
+  return (results, chunkCounters)
+
+def readGrammarLines(f):
+  line = f.readline()
+  grammarLines = []
+  while line.strip() != "":
+    grammarLines.append(line)
+    line = f.readline()
+  return grammarLines
+
+def readTestLines(f):
+  # messages are handed out one at a time as they are read, the file is never held in memory as a whole
+  for line in f:
+    yield line.strip()
+
+def chunkLines(lines, chunkSize):
+  chunk = []
+  for line in lines:
+    chunk.append(line)
+    if len(chunk) == chunkSize:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def collectWorkerChunk(chunk, pendingResult):
+  (chunkResults, chunkCounters) = pendingResult.get()
+  stats.counters.update(chunkCounters)
+  return zip(chunk, chunkResults)
+
+def matchLinesInParallel(lines, grammarLines):
+  with multiprocessing.Pool(WORKER_COUNT, initializer=initializeWorker, initargs=(grammarLines, COLLECT_STATS)) as pool:
+    # only a few chunks are in flight at any time, so reading never runs far ahead of matching
+    pendingChunks = collections.deque()
+    for chunk in chunkLines(lines, CHUNK_SIZE):
+      pendingChunks.append((chunk, pool.apply_async(matchLinesInWorker, (chunk,))))
+      if len(pendingChunks) > 2 * WORKER_COUNT:
+        yield from collectWorkerChunk(*pendingChunks.popleft())
+    while pendingChunks:
+      yield from collectWorkerChunk(*pendingChunks.popleft())
+
+def matchLinesInSequence(lines, grammarDictionary, compiledGrammar):
+  for chunk in chunkLines(lines, CHUNK_SIZE):
+    yield from zip(chunk, matchLines(chunk, grammarDictionary, compiledGrammar))
+
+stats = RunStats()
+
+def enableStats():
+  # puts the counting wrappers in, once - main() calls this when COLLECT_STATS is set, library callers can call it themselves
+  global COLLECT_STATS
+  COLLECT_STATS = True
+  stats.countCalls(GrammarRule, "tryMatch", lambda rule, *args: f"tryMatch rule {rule.name}")
+  stats.countCalls(GrammarRule, "matchEnds", lambda rule, *args: f"matchEnds rule {rule.name}")
+  stats.countCalls(GrammarRule, "matchSpans", lambda rule, *args: f"matchSpans rule {rule.name}")
+  stats.countCalls(SolutionCandidate, "__init__", "SolutionCandidate allocations")
+
+def matchInput(f):
+  # (line, doesMatch) for every message in f, matched against the rules at the top of f as the lines are read
+  with stats.phase("read grammar"):
+    grammarLines = readGrammarLines(f)
+  testLines = readTestLines(f)
+  if WORKER_COUNT > 1:
+    return matchLinesInParallel(testLines, grammarLines)
+  with stats.phase("load grammar"):
+    (grammarDictionary, compiledGrammar) = loadGrammar(grammarLines)
+  return matchLinesInSequence(testLines, grammarDictionary, compiledGrammar)
+
+def main():
+  if COLLECT_STATS:
+    enableStats()
+  # lines are read while they are matched, so the file stays open until the last one is through - stdin is left open
+  with (contextlib.nullcontext(sys.stdin) if INPUT_FILE == "-" else open(INPUT_FILE, "r")) as f:
+    lineResults = matchInput(f)
+
+    count = 0
+    with stats.phase("match lines"):
+      for testLine, doesMatch in lineResults:
+        if doesMatch:
+          print(f"matched line {testLine}")
+          count += 1
+
+  print(count)
+
+  if COLLECT_STATS:
+    stats.write(STATS_FILE)
+
+if __name__ == "__main__":
+  main()
@@ -1,8 +1,109 @@
 #!/bin/python3
 
-DEBUG = False
+# count calls on the hot paths and time every phase, left off the counting wrappers never get installed -
+# library callers turn it on through enableStats()
+COLLECT_STATS = False
+# where the collected stats are written as json at the end of a run, "-" prints them instead
+STATS_FILE = "stats.json"
+# "text" keeps tiles and the map as lists of strings, "numpy" keeps them as boolean arrays oriented through array views
+TILE_BACKEND = "text"
+# "bitmask" keeps the map as one integer per row and finds all placements of a template in a row at once,
+# "scan" keeps the map as strings and checks every coordinate cell by cell
+MONSTER_SEARCH = "bitmask"
+# "constraint" backtracks until every tile fits into a rectangular grid, "explorer" greedily walks out from one tile,
+# "incremental" joins every tile to its neighbours as soon as it is read
+TILE_PLACER = "constraint"
+# tiles are parsed and their edges encoded in this many worker processes, 1 prepares everything in this process
+WORKER_COUNT = 1
+# how many tiles get handed to a worker at once
+CHUNK_SIZE = 500
+# "lines" reads the input line by line, "mmap" maps it into memory and reads the tiles straight out of the buffer
+TILE_READER = "lines"
 
+import array
+import collections
+import contextlib
 import enum
+import json
+import mmap
+import multiprocessing
+import random
+import time
+
+class RunStats:
+  # counters for the hot paths and the seconds spent in every phase, only filled in when COLLECT_STATS is set
+  def __init__(self):
+    self.counters = collections.Counter()
+    self.phaseSeconds = {}
+    # (owner, method name) of every method already swapped for a counting one
+    self.wrappedMethods = set()
+    # name -> (numerator counter, denominator counter), divided when the stats are exported
+    self.ratios = {}
+
+  def countCalls(self, owner, methodName, counterName):
+    # the method is swapped for a counting one, so nothing is paid for it unless stats get collected
+    # counterName is either a fixed name or a function working out the name from the call arguments
+    if (owner, methodName) in self.wrappedMethods:
+      return
+    self.wrappedMethods.add((owner, methodName))
+    method = getattr(owner, methodName)
+    counters = self.counters
+    if callable(counterName):
+      def countingMethod(*args, **kwargs):
+        counters[counterName(*args)] += 1
+        return method(*args, **kwargs)
+    else:
+      def countingMethod(*args, **kwargs):
+        counters[counterName] += 1
+        return method(*args, **kwargs)
+    setattr(owner, methodName, countingMethod)
+
+  def countItems(self, owner, methodName, counterName):
+    # like countCalls, but counts the items taken from whatever the method returns
+    if (owner, methodName) in self.wrappedMethods:
+      return
+    self.wrappedMethods.add((owner, methodName))
+    method = getattr(owner, methodName)
+    counters = self.counters
+    def countingMethod(*args, **kwargs):
+      for item in method(*args, **kwargs):
+        counters[counterName] += 1
+        yield item
+    setattr(owner, methodName, countingMethod)
+
+  def addRatio(self, name, numeratorName, denominatorName):
+    self.ratios[name] = (numeratorName, denominatorName)
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    if not COLLECT_STATS:
+      yield
+      return
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.phaseSeconds[name] = self.phaseSeconds.get(name, 0) + time.perf_counter() - start
+
+  def reset(self):
+    # the counting wrappers hold on to the counter object, so it is cleared in place
+    self.counters.clear()
+    self.phaseSeconds.clear()
+
+  def toDict(self):
+    ratios = {}
+    for name, (numeratorName, denominatorName) in self.ratios.items():
+      if self.counters[denominatorName] > 0:
+        ratios[name] = self.counters[numeratorName] / self.counters[denominatorName]
+    return {"counters": dict(sorted(self.counters.items())), "ratios": ratios, "phaseSeconds": dict(self.phaseSeconds)}
+
+  def write(self, path):
+    statsJson = json.dumps(self.toDict(), indent=2)
+    if path == "-":
+      print(statsJson)
+      return
+    with open(path, "w") as statsFile:
+      statsFile.write(statsJson + "\n")
 
 class Edge(enum.Enum):
   RIGHT = 1,
@@ -27,6 +128,9 @@ class Rotation(enum.Enum):
 all_orientations = [Orientation.REGULAR, Orientation.FLIPPED_HORIZONTALLY, Orientation.FLIPPED_VERTICALLY, Orientation.FLIPPED_ALL]
 all_rotations = [Rotation.REGULAR, Rotation.DEG90, Rotation.DEG180, Rotation.DEG270]
 all_directions = [Edge.UPPER, Edge.RIGHT, Edge.LOWER, Edge.LEFT]
+opposite_directions = {Edge.UPPER: Edge.LOWER, Edge.RIGHT: Edge.LEFT, Edge.LOWER: Edge.UPPER, Edge.LEFT: Edge.RIGHT}
+# (row, column) step into each direction
+direction_offsets = {Edge.UPPER: (-1, 0), Edge.RIGHT: (0, 1), Edge.LOWER: (1, 0), Edge.LEFT: (0, -1)}
 
 monster_template = [
   "                  # ",
@@ -34,6 +138,11 @@ monster_template = [
   " #  #  #  #  #  #   "
 ]
 
+# every template in here gets searched for (in all orientations) in a single pass over the map
+search_templates = {
+  "sea monster": monster_template
+}
+
 class ContentManipulator:
   def rotateContent90Degrees(self, content):
     rotatedContent = []
@@ -56,34 +165,16 @@ class ContentManipulator:
     return rotatedContent
 
   def transformContentForOrientation(self, content, orientation, rotation):
-    newContent = content.copy()
+    return self.transformContent(content, d4TransformsByState[(orientation, rotation)])
 
+  def transformContent(self, content, transform):
+    newContent = content.copy()
     # first rotate
-    if rotation == Rotation.DEG90 or rotation == Rotation.DEG180 or rotation == Rotation.DEG270:
+    for _ in range(transform.quarterTurns):
       newContent = self.rotateContent90Degrees(newContent)
-    if rotation == Rotation.DEG180 or rotation == Rotation.DEG270:
-      newContent = self.rotateContent90Degrees(newContent)
-    if rotation == Rotation.DEG270:
-      newContent = self.rotateContent90Degrees(newContent)
-
-    # now flip horizontally
-    if orientation == Orientation.FLIPPED_HORIZONTALLY or orientation == Orientation.FLIPPED_ALL:
-      newNewContent = []
-      for line in newContent:
-        newNewContent.insert(0, line)
-      newContent = newNewContent
-
-    # now flip horizontally
-    if orientation == Orientation.FLIPPED_VERTICALLY or orientation == Orientation.FLIPPED_ALL:
-      i = 0
-      while i < len(newContent):
-        line = newContent[i]
-        newLine = ""
-        for char in line:
-          newLine = char + newLine
-        newContent[i] = newLine
-        i += 1
-
+    # then reverse the order of the lines
+    if transform.flipped:
+      newContent = newContent[::-1]
     return newContent
 
   def selectEdge(self, content, direction):
@@ -109,43 +200,280 @@ class ContentManipulator:
     orientedContent = self.transformContentForOrientation(content, orientation, rotation)
     return self.selectEdge(orientedContent, direction)
 
+  def getEdgeCode(self, content, direction, reversed=False):
+    edge = self.selectEdge(content, direction)
+    return encodeEdge(edge[::-1] if reversed else edge)
+
+  def toContent(self, lines):
+    return lines.copy()
+
+  def toBlockContent(self, tileBlock):
+    return tileBlock.toLines()[1:]
+
+  def toLines(self, content):
+    return content
+
+  def toRowMasks(self, content):
+    return [encodeRow(line, "#") for line in content]
+
+  def removeBorder(self, content):
+    contentLength = len(content)
+    content = content[1:contentLength-1]
+    i = len(content)-1
+    while i >= 0:
+      line = content[i]
+      line = line[1:contentLength-1]
+      content[i] = line
+      i -= 1
+    return content
+
+  def joinContents(self, contentGrid):
+    joinedContent = []
+    for contentRow in contentGrid:
+      i = 0
+      while i < len(contentRow[0]):
+        joinedLine = ""
+        for content in contentRow:
+          joinedLine += content[i]
+        joinedContent.append(joinedLine)
+        i += 1
+    return joinedContent
+
+def encodeRow(line, markers):
+  # bit x is set if column x holds one of the markers
+  rowMask = 0
+  for x, character in enumerate(line):
+    if character in markers:
+      rowMask |= 1 << x
+  return rowMask
+
+class ArrayContentManipulator:
+  def __init__(self):
+    # only needed for this backend, so the text backend keeps working without numpy installed
+    import numpy
+    self.numpy = numpy
+
+  def transformContentForOrientation(self, content, orientation, rotation):
+    return self.transformContent(content, d4TransformsByState[(orientation, rotation)])
+
+  def transformContent(self, content, transform):
+    # the same steps as the text version, but rotating and flipping only ever creates views of the tile
+    newContent = self.numpy.rot90(content, -transform.quarterTurns)
+    if transform.flipped:
+      newContent = newContent[::-1, :]
+    return newContent
+
+  def selectEdge(self, content, direction):
+    if direction == Edge.UPPER:
+      return content[0, :]
+    if direction == Edge.LOWER:
+      return content[-1, :]
+    if direction == Edge.LEFT:
+      return content[:, 0]
+    if direction == Edge.RIGHT:
+      return content[:, -1]
+    raise NotImplementedError()
+
+  def getTransformedEdge(self, content, direction, orientation, rotation):
+    return self.selectEdge(self.transformContentForOrientation(content, orientation, rotation), direction)
+
+  def getEdgeCode(self, content, direction, reversed=False):
+    edge = self.selectEdge(content, direction)
+    if reversed:
+      edge = edge[::-1]
+    # first cell is the most significant bit, like reading the edge as a binary number - packed into a python int,
+    # which unlike an int64 dot product doesn't overflow on edges longer than 63 cells
+    packedEdge = self.numpy.packbits(edge)
+    return int.from_bytes(packedEdge.tobytes(), "big") >> (8 * len(packedEdge) - len(edge))
+
+  def toContent(self, lines):
+    # one byte per cell, compared all at once instead of a character at a time
+    cells = self.numpy.frombuffer("".join(lines).encode(), dtype=self.numpy.uint8)
+    return cells.reshape(len(lines), -1) == ord("#")
+
+  def toBlockContent(self, tileBlock):
+    # the grid is a view into the mapped input that skips the line breaks, only the comparison allocates
+    cells = self.numpy.frombuffer(tileBlock.view, dtype=self.numpy.uint8)
+    grid = self.numpy.lib.stride_tricks.as_strided(cells[tileBlock.headerLength:], shape=(tileBlock.gridSize, tileBlock.gridSize), strides=(tileBlock.gridSize + 1, 1), writeable=False)
+    return grid == ord("#")
+
+  def toLines(self, content):
+    return ["".join("#" if cell else "." for cell in row) for row in content]
+
+  def toRowMasks(self, content):
+    # little bit order puts column x at bit x, same as encodeRow
+    packedRows = self.numpy.packbits(content, axis=1, bitorder="little")
+    return [int.from_bytes(packedRow.tobytes(), "little") for packedRow in packedRows]
+
+  def removeBorder(self, content):
+    return content[1:-1, 1:-1]
+
+  def joinContents(self, contentGrid):
+    return self.numpy.block([[content for content in contentRow] for contentRow in contentGrid])
+
+class D4Transform:
+  def __init__(self, index, orientation, rotation, quarterTurns, flipped):
+    self.index = index
+    # the first orientation/rotation pair that results in this transform
+    self.orientation = orientation
+    self.rotation = rotation
+    # rotate clockwise this many quarter turns, then reverse the order of the lines if flipped
+    self.quarterTurns = quarterTurns
+    self.flipped = flipped
+    # direction -> (side of the untransformed content that ends up facing it, whether it then reads backwards)
+    self.edgeSources = {}
+
+def buildD4Group():
+  transforms = []
+  transformsByState = {}
+  for orientation in all_orientations:
+    for rotation in all_rotations:
+      # reversing every line is the same as turning by 180 degrees and then reversing the order of the lines
+      quarterTurns = all_rotations.index(rotation)
+      flipped = False
+      if orientation == Orientation.FLIPPED_HORIZONTALLY or orientation == Orientation.FLIPPED_ALL:
+        flipped = True
+      if orientation == Orientation.FLIPPED_VERTICALLY or orientation == Orientation.FLIPPED_ALL:
+        quarterTurns += 2
+        flipped = not flipped
+      quarterTurns %= 4
+
+      # the 16 orientation/rotation pairs only describe 8 distinct transforms
+      matchingTransforms = [transform for transform in transforms if transform.quarterTurns == quarterTurns and transform.flipped == flipped]
+      if matchingTransforms:
+        transformsByState[(orientation, rotation)] = matchingTransforms[0]
+      else:
+        transform = D4Transform(len(transforms), orientation, rotation, quarterTurns, flipped)
+        transforms.append(transform)
+        transformsByState[(orientation, rotation)] = transform
+
+  # every cell of this grid is unique, so the transformed grid tells where each side went and which way it reads
+  labelledContent = ["abc", "def", "ghi"]
+  labelledEdges = [contentManipulator.selectEdge(labelledContent, direction) for direction in all_directions]
+  for transform in transforms:
+    transformedContent = contentManipulator.transformContent(labelledContent, transform)
+    for direction in all_directions:
+      edge = contentManipulator.selectEdge(transformedContent, direction)
+      if edge in labelledEdges:
+        transform.edgeSources[direction] = (all_directions[labelledEdges.index(edge)], False)
+      else:
+        transform.edgeSources[direction] = (all_directions[labelledEdges.index(edge[::-1])], True)
+
+  # compositionTable[first.index][second.index] is the transform doing first, then second
+  compositionTable = []
+  for first in transforms:
+    compositionRow = []
+    for second in transforms:
+      composedContent = contentManipulator.transformContent(contentManipulator.transformContent(labelledContent, first), second)
+      for transform in transforms:
+        if contentManipulator.transformContent(labelledContent, transform) == composedContent:
+          compositionRow.append(transform)
+          break
+    compositionTable.append(compositionRow)
+
+  return (transforms, transformsByState, compositionTable)
+
+# monster templates are always handled as text, tiles and the map as whatever TILE_BACKEND asks for
 contentManipulator = ContentManipulator()
+# only built (and numpy only imported) once a tile actually needs it, so importing this module stays cheap
+array_content_manipulator = None
+
+def getTileContentManipulator():
+  global array_content_manipulator
+  if TILE_BACKEND != "numpy":
+    return contentManipulator
+  if array_content_manipulator is None:
+    array_content_manipulator = ArrayContentManipulator()
+  return array_content_manipulator
+
+(d4Transforms, d4TransformsByState, d4CompositionTable) = buildD4Group()
+
+def prepareTile(textualRepresentation):
+  # everything a tile needs that only depends on its text: (title, contents, side codes)
+  # side codes hold the edge code of every side read both ways, in the order of all_directions
+  titleLine = textualRepresentation[0]
+  title = int(titleLine.split("Tile ")[1].split(":")[0])
+  contents = getTileContentManipulator().toContent(textualRepresentation[1:])
+  sideCodes = tuple(getTileContentManipulator().getEdgeCode(contents, direction, reversed) for direction in all_directions for reversed in [False, True])
+  return (title, contents, sideCodes)
+
+def prepareMappedTile(tileBlock):
+  # the same as prepareTile for a tile of a mapped input, contents are left in the buffer until the tile gets oriented
+  sideCodes = tuple(int(side[::-1 if reversed else 1].tobytes().translate(edge_bits), 2) for side in tileBlock.getSides() for reversed in [False, True])
+  return (tileBlock.getTitle(), None, sideCodes)
+
+def getSideCode(sideCodes, direction, reversed):
+  return sideCodes[2 * all_directions.index(direction) + (1 if reversed else 0)]
+
+# the orientation and rotation columns of a TileStore hold indices into these, unknown comes last
+stored_orientations = all_orientations + [Orientation.UNKNOWN]
+stored_rotations = all_rotations + [Rotation.UNKNOWN]
+
+class TileStore:
+  # one column per tile field, entry i of every column belongs to the i-th tile added
+  def __init__(self):
+    self.titles = array.array("q")
+    # eight side codes per tile, in the order prepareTile hands them out - a plain list once a code is wider than 64 bits
+    self.sideCodes = array.array("Q")
+    self.orientations = array.array("b")
+    self.rotations = array.array("b")
+    # only tiles of a mapped input keep their MappedTileBlock, everything else is in contents already
+    self.sources = []
+    self.contents = []
+
+  def addTile(self, textualRepresentation, preparedTile):
+    (title, contents, sideCodes) = preparedTile
+    self.titles.append(title)
+    if type(self.sideCodes) == array.array and max(sideCodes) >= 1 << 64:
+      # edges longer than 64 cells don't fit the fixed width column, their codes go into python ints of any size
+      self.sideCodes = list(self.sideCodes)
+    self.sideCodes.extend(sideCodes)
+    self.orientations.append(len(all_orientations))
+    self.rotations.append(len(all_rotations))
+    self.sources.append(textualRepresentation if contents is None else None)
+    self.contents.append(contents)
+    return len(self.titles) - 1
+
+# tiles made without a store of their own all go in here
+tile_store = TileStore()
 
 class Tile:
-  def __init__(self, textualRepresentation):
-    self.textualRepresentation = textualRepresentation
-    self.initialize()
-    self.orientation = Orientation.UNKNOWN
-    self.rotation = Rotation.UNKNOWN
-    self.contents = self.textualRepresentation.copy()
-    del self.contents[0]    
+  # a view of one tile in a TileStore, the tile itself only knows where to find it
+  __slots__ = ("store", "index")
+
+  def __init__(self, textualRepresentation, preparedTile=None, store=None):
+    if preparedTile is None:
+      preparedTile = prepareTile(textualRepresentation)
+    self.store = store if store is not None else tile_store
+    self.index = self.store.addTile(textualRepresentation, preparedTile)
 
-  def initialize(self):
-    text = self.textualRepresentation.copy()
+  @property
+  def title(self):
+    return self.store.titles[self.index]
 
-    # get tile title
-    titleLine = text.pop(0)
-    self.title = int(titleLine.split("Tile ")[1].split(":")[0])
+  @property
+  def sideCodes(self):
+    return tuple(self.store.sideCodes[8 * self.index:8 * self.index + 8])
 
-    # get tile upper edge in binary representation - left to right
-    upperEdge = text[0]
+  @property
+  def orientation(self):
+    return stored_orientations[self.store.orientations[self.index]]
 
-    # get tile lower edge in binary representation - left to right
-    lowerEdge = text[len(text)-1]
+  @property
+  def rotation(self):
+    return stored_rotations[self.store.rotations[self.index]]
 
-    # get tile left edge in binary representation - top to bottom
-    leftEdge = ""
-    for line in text:
-      leftEdge+=line[0]
+  @property
+  def textualRepresentation(self):
+    return self.store.sources[self.index]
 
-    # get tile right edge in binary representation - top to bottom
-    rightEdge = ""
-    for line in text:
-      rightEdge+=line[len(line)-1]
+  @property
+  def contents(self):
+    return self.store.contents[self.index]
 
   def setState(self, orientation, rotation):
-    self.orientation = orientation
-    self.rotation = rotation
+    self.store.orientations[self.index] = stored_orientations.index(orientation)
+    self.store.rotations[self.index] = stored_rotations.index(rotation)
 
   def hasState(self):
     return self.orientation != Orientation.UNKNOWN and self.rotation != Rotation.UNKNOWN
@@ -153,31 +481,65 @@ class Tile:
   def getEdge(self, direction):
     if self.orientation == Orientation.UNKNOWN or self.rotation == Rotation.UNKNOWN:
       raise NotImplementedError()
-    return contentManipulator.getTransformedEdge(self.contents, direction, self.orientation, self.rotation)
+    return getTileContentManipulator().getTransformedEdge(self.getContents(), direction, self.orientation, self.rotation)
+
+  def getContents(self):
+    # only tiles of a mapped input start out without contents
+    if self.contents is None:
+      self.store.contents[self.index] = getTileContentManipulator().toBlockContent(self.textualRepresentation)
+    return self.contents
 
 class OrientedTile:
   def __init__(self, tile):
     if not tile.hasState():
       raise NotImplementedError()
-    self.contents = contentManipulator.transformContentForOrientation(tile.contents, tile.orientation, tile.rotation)
+    self.contents = getTileContentManipulator().transformContentForOrientation(tile.getContents(), tile.orientation, tile.rotation)
     self.title = tile.title
     self.removeBorder()
 
   def removeBorder(self):
-    contentLength = len(self.contents)
-    del self.contents[contentLength-1]
-    del self.contents[0]
-    i = len(self.contents)-1
-    while i >= 0:
-      line = self.contents[i]
-      line = line[1:contentLength-1]
-      self.contents[i] = line
-      i -= 1
+    self.contents = getTileContentManipulator().removeBorder(self.contents)
+
+# turns the bytes of an edge into the binary digits encodeEdge reads
+edge_bits = bytes.maketrans(b".#", b"01")
+
+def encodeEdge(edge):
+  # edges are read left to right or top to bottom with '#' (or '1') as a set bit
+  return int(edge.replace(".", "0").replace("#", "1"), 2)
+
+class EdgeIndex:
+  def __init__(self, tiles):
+    # (edge code, direction) -> every (tile, transform) that shows this edge on that side,
+    # ordered like a scan over all tiles and transforms would find them
+    self.placements = {}
+    # (tile title, transform index, direction) -> edge code on that side
+    self.edgeCodes = {}
+    for tile in tiles:
+      self.addTile(tile)
+
+  def addTile(self, tile):
+    # each side of the tile read both ways covers every edge any transform can show
+    sideCodes = tile.sideCodes
+    for transform in d4Transforms:
+      for direction in all_directions:
+        (sourceDirection, reversed) = transform.edgeSources[direction]
+        self.addEdge(tile, transform, direction, getSideCode(sideCodes, sourceDirection, reversed))
+
+  def addEdge(self, tile, transform, direction, edgeCode):
+    self.edgeCodes[(tile.title, transform.index, direction)] = edgeCode
+    self.placements.setdefault((edgeCode, direction), []).append((tile, transform))
+
+  def getEdgeCode(self, tile, direction, orientation, rotation):
+    return self.edgeCodes[(tile.title, d4TransformsByState[(orientation, rotation)].index, direction)]
+
+  def getPlacements(self, edgeCode, direction):
+    return self.placements.get((edgeCode, direction), [])
 
 class TileExplorer:
   def __init__(self, tiles):
     self.startTile = tiles[3]
     self.tiles = tiles
+    self.edgeIndex = EdgeIndex(tiles)
     self.checkpoint = self.startTile
     self.currentTile = self.startTile
     self.startTile.setState(Orientation.REGULAR, Rotation.REGULAR)
@@ -203,45 +565,32 @@ class TileExplorer:
   def tryMove(self, direction):
     if not self.currentTile.hasState():
       raise NotImplementedError()
-    moveEdge = self.currentTile.getEdge(direction)
+    moveEdgeCode = self.edgeIndex.getEdgeCode(self.currentTile, direction, self.currentTile.orientation, self.currentTile.rotation)
     complimentaryEdgeDirection = self.getOppositeDirection(direction)
     edgeFound = False
-    if DEBUG:
-      print(f"Looking for next tile in direction {direction} for tile {self.currentTile.title}")
-      print(f"Current tile state is: orientation={self.currentTile.orientation}, rotation={self.currentTile.rotation}")
-    for tile in tiles:
+    for (tile, transform) in self.getMoveCandidates(moveEdgeCode, complimentaryEdgeDirection):
       # don't match the same tile again
       if self.currentTile.title == tile.title:
         continue
-      # if tile already has a state we know which edge to look at
+      # if tile already has a state it has to be the one showing the edge
       if tile.hasState():
-        compareEdge = tile.getEdge(complimentaryEdgeDirection)
-        if compareEdge == moveEdge:
+        if d4TransformsByState[(tile.orientation, tile.rotation)] is transform:
           edgeFound = True
-          if DEBUG:
-            print(f"Found matching edge on tile {tile.title} with state orientation={tile.orientation},rotation={tile.rotation}")
-            print(f"Matching edge is {moveEdge}")
           self.currentTile = tile
+          break
 
-      # we don't have a state for this tile yet, look at all possible combinations and update state if match is found
+      # we don't have a state for this tile yet, the first placement showing the edge decides it
       else:
-        for orientation in all_orientations:
-          for rotation in all_rotations:
-            currentEdge = contentManipulator.getTransformedEdge(tile.contents, complimentaryEdgeDirection, orientation, rotation)
-            if currentEdge == moveEdge:
-              edgeFound = True
-              tile.setState(orientation, rotation)
-              self.currentTile = tile
-              break
-          if edgeFound:
-            break
-        if edgeFound:
-          break
-    if DEBUG:
-      if not edgeFound:
-        print(f"Unable to move into direction {direction}")
+        edgeFound = True
+        tile.setState(transform.orientation, transform.rotation)
+        self.currentTile = tile
+        break
     return edgeFound
 
+  def getMoveCandidates(self, edgeCode, direction):
+    # only tiles that can show the same edge on the opposite side are worth looking at
+    return self.edgeIndex.getPlacements(edgeCode, direction)
+
   def setCheckPoint(self):
     self.checkpoint = self.currentTile
 
@@ -267,6 +616,506 @@ class TileExplorer:
     
     return orientedTileMap
 
+def orientTiles(placementRows):
+  # sets the state of every tile in rows of (tile, transform) and returns them as rows of oriented tiles
+  orientedTileMap = []
+  for placementRow in placementRows:
+    orientedTileRow = []
+    for (tile, transform) in placementRow:
+      tile.setState(transform.orientation, transform.rotation)
+      orientedTileRow.append(OrientedTile(tile))
+    orientedTileMap.append(orientedTileRow)
+  return orientedTileMap
+
+class TilePlacer:
+  def __init__(self, tiles):
+    self.tiles = tiles
+    self.edgeIndex = EdgeIndex(tiles)
+    # (tile title, transform index, direction) of every edge no other tile shows, these can only be on the outside of the map
+    self.openEdges = set()
+    for ((title, transformIndex, direction), edgeCode) in self.edgeIndex.edgeCodes.items():
+      partners = self.edgeIndex.getPlacements(edgeCode, opposite_directions[direction])
+      if all(tile.title == title for (tile, transform) in partners):
+        self.openEdges.add((title, transformIndex, direction))
+    self.openEdgeTileCounts = self.countOpenEdgeTiles()
+    # (rows, columns) of every grid holding all tiles with room for their open edges
+    self.gridShapes = [shape for shape in self.getGridShapes() if self.hasRoomForOpenEdges(shape)]
+    # (row, column) -> (tile, transform) placed there, the first tile sits at (0, 0)
+    self.grid = {}
+    self.usedTitles = set()
+    # empty cells next to a placed tile, in the order they were reached
+    self.frontier = {}
+    # the frontier cells within the bounds, the holes between the placed tiles
+    self.holes = {}
+    # frontier cell -> every (tile, transform) showing the edges its placed neighbours ask for, used titles included
+    self.candidates = {}
+    # frontier cell -> how many of its candidates have a title not used yet
+    self.candidateCounts = {}
+    # tile title -> frontier cell -> how many of the cell's candidates are that tile
+    self.candidateCells = {}
+    # (minimum row, maximum row, minimum column, maximum column) of the placed tiles
+    self.bounds = None
+    # for each of the bounds, whether the map is known to end there
+    self.closedSides = None
+
+  def getGridShapes(self):
+    tileCount = len(self.tiles)
+    return [(rows, tileCount // rows) for rows in range(1, tileCount + 1) if tileCount % rows == 0]
+
+  def countOpenEdgeTiles(self):
+    # a tile with two open edges next to each other has to go into a corner, or the end of a single line of tiles,
+    # and one with open edges on opposite sides only fits into a single line of tiles
+    (borderTileCount, cornerTileCount, lineTileCount) = (0, 0, 0)
+    for tile in self.tiles:
+      openDirections = [direction for direction in all_directions if (tile.title, 0, direction) in self.openEdges]
+      hasOppositeOpenEdges = any(opposite_directions[direction] in openDirections for direction in openDirections)
+      if openDirections:
+        borderTileCount += 1
+      if hasOppositeOpenEdges:
+        lineTileCount += 1
+      if len(openDirections) > 2 or (len(openDirections) == 2 and not hasOppositeOpenEdges):
+        cornerTileCount += 1
+    return (borderTileCount, cornerTileCount, lineTileCount)
+
+  def hasRoomForOpenEdges(self, shape):
+    (rows, columns) = shape
+    if rows == 1 and columns == 1:
+      return True
+    (borderTileCount, cornerTileCount, lineTileCount) = self.openEdgeTileCounts
+    if rows == 1 or columns == 1:
+      return cornerTileCount <= 2
+    return lineTileCount == 0 and cornerTileCount <= 4 and borderTileCount <= 2 * (rows + columns) - 4
+
+  def getEdgeCode(self, placement, direction):
+    (tile, transform) = placement
+    return self.edgeIndex.edgeCodes[(tile.title, transform.index, direction)]
+
+  def getNeighbours(self, cell):
+    (row, column) = cell
+    return [((row - 1, column), Edge.UPPER), ((row, column + 1), Edge.RIGHT), ((row + 1, column), Edge.LOWER), ((row, column - 1), Edge.LEFT)]
+
+  def isInside(self, cell):
+    (row, column) = cell
+    (minRow, maxRow, minColumn, maxColumn) = self.bounds
+    return minRow <= row <= maxRow and minColumn <= column <= maxColumn
+
+  def getBounds(self, cell):
+    (row, column) = cell
+    (minRow, maxRow, minColumn, maxColumn) = self.bounds
+    return (min(minRow, row), max(maxRow, row), min(minColumn, column), max(maxColumn, column))
+
+  def fitsGridShape(self, bounds, closedSides):
+    # some grid holding all tiles has to be able to cover the bounds, exactly so along closed sides
+    (minRow, maxRow, minColumn, maxColumn) = bounds
+    (height, width) = (maxRow - minRow + 1, maxColumn - minColumn + 1)
+    heightFixed = closedSides[0] and closedSides[1]
+    widthFixed = closedSides[2] and closedSides[3]
+    for (rows, columns) in self.gridShapes:
+      if rows >= height and columns >= width and (rows == height or not heightFixed) and (columns == width or not widthFixed):
+        return True
+    return False
+
+  def canGrowInto(self, cell):
+    (row, column) = cell
+    (minRow, maxRow, minColumn, maxColumn) = self.bounds
+    (upperClosed, lowerClosed, leftClosed, rightClosed) = self.closedSides
+    if (row < minRow and upperClosed) or (row > maxRow and lowerClosed) or (column < minColumn and leftClosed) or (column > maxColumn and rightClosed):
+      return False
+    return self.fitsGridShape(self.getBounds(cell), self.closedSides)
+
+  def setCandidates(self, cell):
+    # only the placed neighbours of a cell change its candidates, so they are looked up again when one of them does
+    self.dropCandidates(cell)
+    requiredEdges = []
+    for (neighbour, direction) in self.getNeighbours(cell):
+      if neighbour in self.grid:
+        requiredEdges.append((self.getEdgeCode(self.grid[neighbour], opposite_directions[direction]), direction))
+    (edgeCode, direction) = requiredEdges[0]
+    candidates = []
+    candidateCount = 0
+    for candidate in self.edgeIndex.getPlacements(edgeCode, direction):
+      if all(self.getEdgeCode(candidate, direction) == edgeCode for (edgeCode, direction) in requiredEdges[1:]):
+        candidates.append(candidate)
+        title = candidate[0].title
+        cells = self.candidateCells.setdefault(title, {})
+        cells[cell] = cells.get(cell, 0) + 1
+        if title not in self.usedTitles:
+          candidateCount += 1
+    self.candidates[cell] = candidates
+    self.candidateCounts[cell] = candidateCount
+
+  def dropCandidates(self, cell):
+    for (tile, transform) in self.candidates.pop(cell, []):
+      cells = self.candidateCells[tile.title]
+      cells[cell] -= 1
+      if cells[cell] == 0:
+        del cells[cell]
+    self.candidateCounts.pop(cell, None)
+
+  def setTitleUsed(self, title, used):
+    # a tile being placed, or taken back out, changes the counts of just the cells it is a candidate for
+    if used:
+      self.usedTitles.add(title)
+    else:
+      self.usedTitles.remove(title)
+    step = -1 if used else 1
+    for (cell, count) in self.candidateCells.get(title, {}).items():
+      self.candidateCounts[cell] += step * count
+
+  def findHoles(self):
+    self.holes = {cell: True for cell in self.frontier if self.isInside(cell)}
+
+  def getCandidates(self, cell):
+    # every unused (tile, transform) showing the edges the tiles already placed around the cell ask for
+    return [candidate for candidate in self.candidates[cell] if candidate[0].title not in self.usedTitles]
+
+  def selectCell(self):
+    # returns the next cell to decide on and the placements to try there, where None stands for the map ending before it
+    # cells between the placed tiles have to be filled and go first, so a wrong placement shows up as a hole nothing fits into
+    selectedCell = None
+    for cell in self.holes:
+      if selectedCell is None or self.candidateCounts[cell] < self.candidateCounts[selectedCell]:
+        selectedCell = cell
+        if self.candidateCounts[cell] <= 1:
+          break
+    if selectedCell is not None:
+      return (selectedCell, self.getCandidates(selectedCell))
+
+    # otherwise the map grows by one cell, or ends right before it, which is the only option if nothing fits there
+    for cell in self.frontier:
+      if not self.canGrowInto(cell):
+        continue
+      if selectedCell is None or self.candidateCounts[cell] < self.candidateCounts[selectedCell]:
+        selectedCell = cell
+        if self.candidateCounts[cell] == 0:
+          break
+    if selectedCell is None:
+      return (None, [])
+    return (selectedCell, self.getCandidates(selectedCell) + [None])
+
+  def addPlacement(self, cell, placement):
+    # returns everything needed to undo the placement again, and whether the map can still be completed
+    previousBounds = self.bounds
+    previousClosedSides = self.closedSides
+    (row, column) = cell
+    if placement is None:
+      (minRow, maxRow, minColumn, maxColumn) = self.bounds
+      (upperClosed, lowerClosed, leftClosed, rightClosed) = self.closedSides
+      self.closedSides = (upperClosed or row < minRow, lowerClosed or row > maxRow, leftClosed or column < minColumn, rightClosed or column > maxColumn)
+      return ((previousBounds, previousClosedSides, False, None), self.fitsGridShape(self.bounds, self.closedSides))
+
+    self.grid[cell] = placement
+    self.setTitleUsed(placement[0].title, True)
+    self.bounds = self.getBounds(cell) if self.bounds is not None else (row, row, column, column)
+    wasFrontier = self.frontier.pop(cell, False)
+    self.holes.pop(cell, None)
+    self.dropCandidates(cell)
+    addedCells = []
+    for (neighbour, direction) in self.getNeighbours(cell):
+      if neighbour in self.grid:
+        continue
+      if neighbour not in self.frontier:
+        self.frontier[neighbour] = True
+        addedCells.append(neighbour)
+        if self.isInside(neighbour):
+          self.holes[neighbour] = True
+      self.setCandidates(neighbour)
+    if self.bounds != previousBounds:
+      self.findHoles()
+    changes = (previousBounds, previousClosedSides, wasFrontier, addedCells)
+
+    # the map ends right at an open edge, which it can't if there is a placed tile further out
+    (tile, transform) = placement
+    (minRow, maxRow, minColumn, maxColumn) = self.bounds
+    (upperClosed, lowerClosed, leftClosed, rightClosed) = self.closedSides
+    for direction in all_directions:
+      if (tile.title, transform.index, direction) not in self.openEdges:
+        continue
+      if direction == Edge.UPPER:
+        (upperClosed, canEnd) = (True, row == minRow)
+      elif direction == Edge.RIGHT:
+        (rightClosed, canEnd) = (True, column == maxColumn)
+      elif direction == Edge.LOWER:
+        (lowerClosed, canEnd) = (True, row == maxRow)
+      else:
+        (leftClosed, canEnd) = (True, column == minColumn)
+      if not canEnd:
+        return (changes, False)
+    self.closedSides = (upperClosed, lowerClosed, leftClosed, rightClosed)
+    return (changes, self.fitsGridShape(self.bounds, self.closedSides))
+
+  def removePlacement(self, cell, changes):
+    (previousBounds, previousClosedSides, wasFrontier, addedCells) = changes
+    placedBounds = self.bounds
+    self.bounds = previousBounds
+    self.closedSides = previousClosedSides
+    if addedCells is None:
+      return
+    for neighbour in addedCells:
+      del self.frontier[neighbour]
+      self.holes.pop(neighbour, None)
+      self.dropCandidates(neighbour)
+    if wasFrontier:
+      self.frontier[cell] = True
+    self.setTitleUsed(self.grid.pop(cell)[0].title, False)
+    for (neighbour, direction) in self.getNeighbours(cell):
+      if neighbour in self.frontier:
+        self.setCandidates(neighbour)
+    if wasFrontier:
+      self.setCandidates(cell)
+    if self.bounds != placedBounds:
+      self.findHoles()
+    elif wasFrontier:
+      self.holes[cell] = True
+
+  def placeTiles(self, stepLimit, shuffler):
+    # returns (rows of placements or None, whether every possible placement was tried)
+    self.grid = {}
+    self.usedTitles = set()
+    self.frontier = {}
+    self.holes = {}
+    self.candidates = {}
+    self.candidateCounts = {}
+    self.candidateCells = {}
+    self.bounds = None
+    self.closedSides = (False, False, False, False)
+    # turning or flipping the whole map doesn't change it, so the first tile can keep its orientation
+    startPlacement = (self.tiles[0], d4TransformsByState[(Orientation.REGULAR, Rotation.REGULAR)])
+    # one entry per decision: [cell, the placements to try there, how many of them were tried, changes to undo]
+    stack = [[(0, 0), [startPlacement], 0, None]]
+    stepCount = 0
+    while stack:
+      entry = stack[-1]
+      # coming back to a decision means whatever was chosen there led to a dead end
+      if entry[3] is not None:
+        self.removePlacement(entry[0], entry[3])
+        entry[3] = None
+      placements = entry[1]
+      while entry[2] < len(placements) and placements[entry[2]] is not None and placements[entry[2]][0].title in self.usedTitles:
+        entry[2] += 1
+      if entry[2] == len(placements):
+        stack.pop()
+        continue
+      (entry[3], canComplete) = self.addPlacement(entry[0], placements[entry[2]])
+      entry[2] += 1
+      if not canComplete:
+        continue
+      if len(self.usedTitles) == len(self.tiles):
+        (minRow, maxRow, minColumn, maxColumn) = self.bounds
+        return ([[self.grid[(row, column)] for column in range(minColumn, maxColumn + 1)] for row in range(minRow, maxRow + 1)], True)
+      stepCount += 1
+      if stepCount > stepLimit:
+        return (None, False)
+      (cell, placements) = self.selectCell()
+      if placements:
+        if shuffler is not None:
+          # the map ending before the cell stays the last thing to try
+          candidates = [placement for placement in placements if placement is not None]
+          shuffler.shuffle(candidates)
+          placements = candidates + placements[len(candidates):]
+        stack.append([cell, placements, 0, None])
+    return (None, True)
+
+  def uncoverMap(self):
+    # one wrong guess early on can keep backtracking busy for ages below it, so the search only gets
+    # a limited number of steps, and starts over in a shuffled order with twice as many if it runs out
+    stepLimit = 4 * len(self.tiles)
+    attempt = 0
+    while True:
+      shuffler = random.Random(attempt) if attempt > 0 else None
+      (placementRows, exhausted) = self.placeTiles(stepLimit, shuffler)
+      if placementRows is not None:
+        return orientTiles(placementRows)
+      if exhausted:
+        raise RuntimeError(f"unable to put {len(self.tiles)} tiles together into a rectangular map")
+      stepLimit *= 2
+      attempt += 1
+
+def transformOffset(transform, offset):
+  # whatever lay next to a side of a tile lies next to wherever that side ends up facing
+  targetDirections = {sourceDirection: direction for (direction, (sourceDirection, reversed)) in transform.edgeSources.items()}
+  (upperRow, upperColumn) = direction_offsets[targetDirections[Edge.UPPER]]
+  (rightRow, rightColumn) = direction_offsets[targetDirections[Edge.RIGHT]]
+  (row, column) = offset
+  return (-row * upperRow + column * rightRow, -row * upperColumn + column * rightColumn)
+
+def invertTransform(transform):
+  identity = d4TransformsByState[(Orientation.REGULAR, Rotation.REGULAR)]
+  for inverse in d4Transforms:
+    if d4CompositionTable[transform.index][inverse.index] is identity:
+      return inverse
+
+class IncrementalAssembler:
+  def __init__(self):
+    self.tiles = []
+    self.edgeIndex = EdgeIndex([])
+    # union-find over tile titles, every root stands for one piece of the map put together so far
+    self.parents = {}
+    # root title -> titles of all tiles in the piece
+    self.members = {}
+    # tile title -> (row, column, transform) in the frame of the piece it belongs to
+    self.placements = {}
+    # root title -> (row, column) -> title of the tile placed there
+    self.cells = {}
+    # (title, direction, partner title, partner transforms) of joins across an edge reading the same both ways
+    self.pendingJoins = []
+
+  def findRoot(self, title):
+    root = title
+    while self.parents[root] != root:
+      root = self.parents[root]
+    # point everything on the way straight at the root, so the next lookup is quick
+    while self.parents[title] != root:
+      (self.parents[title], title) = (root, self.parents[title])
+    return root
+
+  def addTile(self, tile):
+    identity = d4TransformsByState[(Orientation.REGULAR, Rotation.REGULAR)]
+    self.tiles.append(tile)
+    self.edgeIndex.addTile(tile)
+    self.parents[tile.title] = tile.title
+    self.members[tile.title] = [tile.title]
+    self.placements[tile.title] = (0, 0, identity)
+    self.cells[tile.title] = {(0, 0): tile.title}
+
+    # join the new tile to every tile already there that shows one of its edges on the opposite side
+    for direction in all_directions:
+      edgeCode = self.edgeIndex.edgeCodes[(tile.title, identity.index, direction)]
+      partnerTransforms = collections.defaultdict(list)
+      for (partner, transform) in self.edgeIndex.getPlacements(edgeCode, opposite_directions[direction]):
+        if partner.title != tile.title:
+          partnerTransforms[partner.title].append(transform)
+      for (partnerTitle, transforms) in partnerTransforms.items():
+        # an edge reading the same both ways fits the partner flipped either way, the other edges decide which one it is
+        # once the joins they take part in have put the pieces together
+        if len(transforms) == 1:
+          self.joinPieces(tile.title, direction, partnerTitle, transforms[0])
+        else:
+          self.pendingJoins.append((tile.title, direction, partnerTitle, transforms))
+
+  def joinPieces(self, title, direction, partnerTitle, partnerTransform):
+    plan = self.planJoin(title, direction, partnerTitle, partnerTransform)
+    if plan is None:
+      return
+    (root, partnerRoot, movedPlacements) = plan
+    for (member, (memberRow, memberColumn, memberTransform)) in movedPlacements.items():
+      self.placements[member] = (memberRow, memberColumn, memberTransform)
+      self.cells[root][(memberRow, memberColumn)] = member
+    self.members[root].extend(self.members.pop(partnerRoot))
+    del self.cells[partnerRoot]
+    self.parents[partnerRoot] = root
+
+  def planJoin(self, title, direction, partnerTitle, partnerTransform):
+    # returns (root staying put, root of the piece moving, member -> (row, column, transform) after the move),
+    # or None if the tiles are in one piece already or the pieces would overlap
+    # the partner shows the matching edge when it lies in direction of the untransformed tile, turned by partnerTransform
+    root = self.findRoot(title)
+    partnerRoot = self.findRoot(partnerTitle)
+    if root == partnerRoot:
+      return None
+
+    # where the partner has to go in the frame of the tile's piece
+    (row, column, transform) = self.placements[title]
+    (rowOffset, columnOffset) = transformOffset(transform, direction_offsets[direction])
+    targetTransform = d4CompositionTable[partnerTransform.index][transform.index]
+    # the partner's whole piece moves along: first turned so the partner ends up in targetTransform, then shifted into place
+    (partnerRow, partnerColumn, partnerPieceTransform) = self.placements[partnerTitle]
+    frameTransform = d4CompositionTable[invertTransform(partnerPieceTransform).index][targetTransform.index]
+    (turnedRow, turnedColumn) = transformOffset(frameTransform, (partnerRow, partnerColumn))
+    shift = (row + rowOffset - turnedRow, column + columnOffset - turnedColumn)
+
+    # the smaller piece is the one that moves
+    if len(self.members[partnerRoot]) > len(self.members[root]):
+      (root, partnerRoot) = (partnerRoot, root)
+      frameTransform = invertTransform(frameTransform)
+      (shiftRow, shiftColumn) = transformOffset(frameTransform, shift)
+      shift = (-shiftRow, -shiftColumn)
+
+    movedPlacements = {}
+    for member in self.members[partnerRoot]:
+      (memberRow, memberColumn, memberTransform) = self.placements[member]
+      (turnedRow, turnedColumn) = transformOffset(frameTransform, (memberRow, memberColumn))
+      cell = (turnedRow + shift[0], turnedColumn + shift[1])
+      # edges that only look alike can make two pieces overlap, those stay apart
+      if cell in self.cells[root]:
+        return None
+      movedPlacements[member] = (cell[0], cell[1], d4CompositionTable[memberTransform.index][frameTransform.index])
+    return (root, partnerRoot, movedPlacements)
+
+  def countSeamMatches(self, plan):
+    # how many edges the moved piece has in common with the tiles it ends up next to, None if any of them don't fit
+    (root, partnerRoot, movedPlacements) = plan
+    cells = self.cells[root]
+    matchCount = 0
+    for (member, (row, column, transform)) in movedPlacements.items():
+      for direction in all_directions:
+        (rowOffset, columnOffset) = direction_offsets[direction]
+        neighbour = cells.get((row + rowOffset, column + columnOffset))
+        if neighbour is None:
+          continue
+        neighbourTransform = self.placements[neighbour][2]
+        if self.edgeIndex.edgeCodes[(member, transform.index, direction)] != self.edgeIndex.edgeCodes[(neighbour, neighbourTransform.index, opposite_directions[direction])]:
+          return None
+        matchCount += 1
+    return matchCount
+
+  def resolvePendingJoins(self):
+    # a flip putting a tile next to one it doesn't fit is out, and of the rest the one sharing the most edges wins -
+    # only when nothing tells the flips apart any more, like along a single line of tiles, the first one does
+    while self.pendingJoins:
+      undecidedJoins = []
+      hasJoined = False
+      for (title, direction, partnerTitle, transforms) in self.pendingJoins:
+        options = []
+        for transform in transforms:
+          plan = self.planJoin(title, direction, partnerTitle, transform)
+          matchCount = self.countSeamMatches(plan) if plan is not None else None
+          if matchCount is not None:
+            options.append((matchCount, transform))
+        if not options:
+          continue
+        bestCount = max(matchCount for (matchCount, transform) in options)
+        bestTransforms = [transform for (matchCount, transform) in options if matchCount == bestCount]
+        if len(bestTransforms) > 1:
+          undecidedJoins.append(((title, direction, partnerTitle, transforms), bestTransforms[0]))
+          continue
+        self.joinPieces(title, direction, partnerTitle, bestTransforms[0])
+        hasJoined = True
+      if not hasJoined and undecidedJoins:
+        ((title, direction, partnerTitle, transforms), transform) = undecidedJoins.pop(0)
+        self.joinPieces(title, direction, partnerTitle, transform)
+      self.pendingJoins = [pendingJoin for (pendingJoin, transform) in undecidedJoins]
+
+  def getPieceCount(self):
+    return len(self.members)
+
+  def getAssembly(self, title):
+    # rows of (tile, transform) for the piece holding the tile, None where nothing has been placed yet
+    cells = self.cells[self.findRoot(title)]
+    rows = [row for (row, column) in cells]
+    columns = [column for (row, column) in cells]
+    tilesByTitle = {tile.title: tile for tile in self.tiles}
+    assembly = []
+    for row in range(min(rows), max(rows) + 1):
+      assemblyRow = []
+      for column in range(min(columns), max(columns) + 1):
+        if (row, column) in cells:
+          member = cells[(row, column)]
+          assemblyRow.append((tilesByTitle[member], self.placements[member][2]))
+        else:
+          assemblyRow.append(None)
+      assembly.append(assemblyRow)
+    return assembly
+
+  def uncoverMap(self):
+    self.resolvePendingJoins()
+    if self.getPieceCount() != 1:
+      raise RuntimeError(f"tiles only came together in {self.getPieceCount()} separate pieces, edges matching more than one tile need the constraint placer")
+    assembly = self.getAssembly(self.tiles[0].title)
+    if any(placement is None for assemblyRow in assembly for placement in assemblyRow):
+      raise RuntimeError("tiles came together in a piece that isn't rectangular")
+    return orientTiles(assembly)
+
 class MapBuilder():
   def __init__(self, orientedTileMap):
     self.orientedTileMap = orientedTileMap
@@ -277,41 +1126,164 @@ class MapBuilder():
         print(f"{tile.title} ", end="")
       print("")
 
+  def buildMapContent(self):
+    return getTileContentManipulator().joinContents([[tile.contents for tile in tileRow] for tileRow in self.orientedTileMap])
+
   def buildMap(self):
-    map = []
+    return getTileContentManipulator().toLines(self.buildMapContent())
+
+  def buildImage(self):
+    rows = []
     for tileRow in self.orientedTileMap:
-      i = 0
-      while i < len(tileRow[0].contents):
-        mapRow = ""
-        for tile in tileRow:
-          mapRow += tile.contents[i]
-        map.append(mapRow)
-        i += 1
-    return map
+      tileWidth = len(tileRow[0].contents[0])
+      tileRowMasks = [getTileContentManipulator().toRowMasks(tile.contents) for tile in tileRow]
+      for i in range(len(tileRowMasks[0])):
+        # every tile further right lands one tile width higher up in the row
+        rowMask = 0
+        for tileIndex, rowMasks in enumerate(tileRowMasks):
+          rowMask |= rowMasks[i] << (tileIndex * tileWidth)
+        rows.append(rowMask)
+    return BitImage(rows, tileWidth * len(self.orientedTileMap[0]))
 
   def printLines(self, lines):
     for line in lines:
       print(line)
 
+class BitImage:
+  def __init__(self, rows, width):
+    self.width = width
+    self.height = len(rows)
+    # bit x of a row is set where the image has a '#' in column x
+    self.rows = rows
+    # same layout, set where a monster has been found
+    self.markedRows = [0] * len(rows)
+
+  def markTemplate(self, x, y, template):
+    for y_i, line in enumerate(template):
+      self.markedRows[y+y_i] |= encodeRow(line, "#") << x
+
+  def getRoughness(self):
+    return sum((row & ~markedRow).bit_count() for row, markedRow in zip(self.rows, self.markedRows))
+
+  def toLines(self):
+    lines = []
+    for row, markedRow in zip(self.rows, self.markedRows):
+      line = ""
+      for x in range(self.width):
+        if (markedRow >> x) & 1:
+          line += "O"
+        elif (row >> x) & 1:
+          line += "#"
+        else:
+          line += "."
+      lines.append(line)
+    return lines
+
+class TemplateVariant:
+  def __init__(self, name, transform, template):
+    self.name = name
+    self.transform = transform
+    self.template = template
+    self.width = len(template[0])
+    self.height = len(template)
+
+class PatternTrieNode:
+  def __init__(self):
+    self.children = {}
+    # variants whose last row ends at this node
+    self.variants = []
+
+class PatternSearch:
+  def __init__(self, templates):
+    # every template under every transform, with transforms that give the same shape (symmetric templates) only kept once
+    self.variants = []
+    for name, template in templates.items():
+      seenShapes = []
+      for transform in d4Transforms:
+        transformedTemplate = contentManipulator.transformContent(template, transform)
+        if transformedTemplate in seenShapes:
+          continue
+        seenShapes.append(transformedTemplate)
+        self.variants.append(TemplateVariant(name, transform, transformedTemplate))
+
+    # templates are stored row by row in a trie keyed by the '#' columns of each row, so variants starting
+    # with the same rows share the work for those rows, much like Aho-Corasick shares common prefixes
+    self.root = PatternTrieNode()
+    for variant in self.variants:
+      node = self.root
+      for line in variant.template:
+        columns = tuple(x for x, character in enumerate(line) if character == "#")
+        node = node.children.setdefault(columns, PatternTrieNode())
+      node.variants.append(variant)
+
+  def findPlacements(self, image):
+    # returns (variant, x, y) for every placement of every variant
+    placements = []
+    allColumnsMask = (1 << image.width) - 1
+    # row index -> shift -> row shifted right by that many columns, shared by every variant needing it
+    shiftedRows = {}
+    for y in range(image.height):
+      shiftedRows.pop(y-1, None)
+      self.searchNode(self.root, image, y, 0, allColumnsMask, shiftedRows, placements)
+    return placements
+
+  def searchNode(self, node, image, y, depth, candidates, shiftedRows, placements):
+    for variant in node.variants:
+      if variant.width > image.width:
+        continue
+      # bits for every column the variant still fits into when placed there
+      variantCandidates = candidates & ((1 << (image.width - variant.width + 1)) - 1)
+      while variantCandidates:
+        lowestCandidate = variantCandidates & -variantCandidates
+        placements.append((variant, lowestCandidate.bit_length() - 1, y))
+        variantCandidates ^= lowestCandidate
+
+    if y + depth >= image.height:
+      return
+    rowShifts = shiftedRows.setdefault(y + depth, {})
+    for columns, child in node.children.items():
+      # shifting a row right by a template column lines that column up with bit x for every placement x at once
+      childCandidates = candidates
+      for x_i in columns:
+        if x_i not in rowShifts:
+          rowShifts[x_i] = image.rows[y + depth] >> x_i
+        childCandidates &= rowShifts[x_i]
+        if not childCandidates:
+          break
+      if childCandidates:
+        self.searchNode(child, image, y, depth + 1, childCandidates, shiftedRows, placements)
+
+class ImageMonsterFinder:
+  def __init__(self, image, templates):
+    self.image = image
+    self.patternSearch = PatternSearch(templates)
+
+  def findMonsters(self):
+    for variant in self.patternSearch.variants:
+      print(f"check for {variant.name} with configuration: orientation={variant.transform.orientation},rotation={variant.transform.rotation}")
+    # marking never touches the image rows themselves, so all variants are searched in one go
+    for (variant, x, y) in self.patternSearch.findPlacements(self.image):
+      self.image.markTemplate(x, y, variant.template)
+
 class MonsterFinder:
   def __init__(self, map):
     self.map = map
     self.validMonsterMarkers = ['#', 'O']
 
   def findMonsters(self):
-    for orientation in all_orientations:
-      for rotation in all_rotations:
-        print(f"check for monsters with configuration: orientation={orientation},rotation={rotation}")
-        current_monster_template = contentManipulator.transformContentForOrientation(monster_template, orientation, rotation)
-        self.markMonstersWithTemplate(current_monster_template)
+    # the 16 orientation/rotation pairs only make 8 distinct templates
+    for transform in d4Transforms:
+      print(f"check for monsters with configuration: orientation={transform.orientation},rotation={transform.rotation}")
+      current_monster_template = contentManipulator.transformContent(monster_template, transform)
+      self.markMonstersWithTemplate(current_monster_template)
   
   def markMonstersWithTemplate(self, monster):
     monsterWidth = len(monster[0])
     monsterHeight = len(monster)
     leftMostCheckIndex = 0
-    rightMostCheckIndex = len(map)-monsterWidth-1
+    rightMostCheckIndex = len(self.map[0])-monsterWidth
     topMostCheckIndex = 0
-    bottomMostCheckIndex = len(map)-monsterHeight-1
+    bottomMostCheckIndex = len(self.map)-monsterHeight
 
     x = leftMostCheckIndex
     while x <= rightMostCheckIndex:
@@ -356,43 +1328,212 @@ class MonsterFinder:
     return True
 
 
-f = open("input.txt", "r")
-line = f.readline()
-tiles = []
-while line:
-  tileLines = []
-  while line.strip() != "":
-    tileLines.append(line.strip())
-    line = f.readline()
-  tiles.append(Tile(tileLines))
+def mapTileFile(f):
+  # the operating system only pages in the parts of the file that actually get looked at, None for an empty file
+  try:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except ValueError:
+    return None
+
+class MappedTileBlock:
+  # one tile of a mapped input file, nothing gets copied out of the buffer until something asks for lines
+  __slots__ = ("view", "headerLength", "gridSize")
+
+  def __init__(self, view, headerLength, gridSize):
+    self.view = view
+    self.headerLength = headerLength
+    self.gridSize = gridSize
+
+  def getTitle(self):
+    return int(self.view[len("Tile "):self.headerLength - 2].tobytes())
+
+  def getRow(self, index):
+    start = self.headerLength + index * (self.gridSize + 1)
+    return self.view[start:start + self.gridSize]
+
+  def getColumn(self, index):
+    return self.view[self.headerLength + index::self.gridSize + 1]
+
+  def getSides(self):
+    # in the order of all_directions, read left to right or top to bottom
+    return [self.getRow(0), self.getColumn(self.gridSize - 1), self.getRow(self.gridSize - 1), self.getColumn(0)]
+
+  def toLines(self):
+    return [self.view[:self.headerLength - 1].tobytes().decode()] + [self.getRow(index).tobytes().decode() for index in range(self.gridSize)]
+
+def findMappedTileBlocks(buffer):
+  # every tile is a "Tile <title>:" line, one line per grid row and a blank line, so the blocks are all equally long -
+  # None if the input isn't laid out like that after all ("\r\n" line breaks, stray spaces, tiles of different sizes)
+  view = memoryview(buffer)
+  headerLength = buffer.find(b"\n") + 1
+  gridSize = buffer.find(b"\n", headerLength) - headerLength
+  blockLength = headerLength + gridSize * (gridSize + 1)
+  if headerLength == 0 or gridSize <= 0:
+    return None
+  tileBlocks = []
+  offset = 0
+  # the last block may be missing its final line break
+  while offset + blockLength - 1 <= len(buffer):
+    block = view[offset:offset + blockLength]
+    if block[:len("Tile ")] != b"Tile " or block[headerLength - 2:headerLength] != b":\n":
+      return None
+    rowEnds = block[headerLength + gridSize::gridSize + 1].tobytes()
+    if len(rowEnds) < gridSize - 1 or rowEnds.count(b"\n") != len(rowEnds):
+      return None
+    tileBlocks.append(MappedTileBlock(block, headerLength, gridSize))
+    offset += blockLength + 1
+  if view[offset:].tobytes().strip():
+    return None
+  return tileBlocks
+
+def readTileBlocks(f):
+  # hands out the lines of one tile at a time
   line = f.readline()
+  while line:
+    tileLines = []
+    while line.strip() != "":
+      tileLines.append(line.strip())
+      line = f.readline()
+    if tileLines:
+      yield tileLines
+    line = f.readline()
+
+def chunkTileBlocks(tileBlocks, chunkSize):
+  chunk = []
+  for tileLines in tileBlocks:
+    chunk.append(tileLines)
+    if len(chunk) == chunkSize:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def prepareTilesInWorker(tileBlocks):
+  return [prepareTile(tileLines) for tileLines in tileBlocks]
+
+def prepareTilesInParallel(tileBlocks, store):
+  # tiles don't depend on each other until they are put together, workers only send back titles, contents and edge codes
+  with multiprocessing.Pool(WORKER_COUNT) as pool:
+    pendingChunks = collections.deque()
+    for chunk in chunkTileBlocks(tileBlocks, CHUNK_SIZE):
+      pendingChunks.append((chunk, pool.apply_async(prepareTilesInWorker, (chunk,))))
+      if len(pendingChunks) > 2 * WORKER_COUNT:
+        (doneChunk, preparedTiles) = pendingChunks.popleft()
+        yield from (Tile(tileBlock, preparedTile, store) for (tileBlock, preparedTile) in zip(doneChunk, preparedTiles.get()))
+    while pendingChunks:
+      (doneChunk, preparedTiles) = pendingChunks.popleft()
+      yield from (Tile(tileBlock, preparedTile, store) for (tileBlock, preparedTile) in zip(doneChunk, preparedTiles.get()))
+
+stats = RunStats()
+
+def enableStats():
+  # puts the counting wrappers in, once - main() calls this when COLLECT_STATS is set, library callers can call it themselves
+  global COLLECT_STATS
+  COLLECT_STATS = True
+  stats.countCalls(TileExplorer, "tryMove", "tryMove calls")
+  stats.countItems(TileExplorer, "getMoveCandidates", "tiles scanned by tryMove")
+  stats.addRatio("tiles scanned per tryMove", "tiles scanned by tryMove", "tryMove calls")
+  stats.countCalls(TilePlacer, "placeTiles", "placeTiles attempts")
+  stats.countCalls(IncrementalAssembler, "joinPieces", "joinPieces calls")
+  # the scan checks one template at one coordinate per call, the bitmask search one template row at every column at once
+  stats.countCalls(MonsterFinder, "checkMonsterAtCoordinate", "monster checks")
+  stats.countCalls(PatternSearch, "searchNode", "monster trie node checks")
+  stats.countCalls(MonsterFinder, "markMonsterAtCoordinate", "monsters marked")
+  stats.countCalls(BitImage, "markTemplate", "monsters marked")
+
+def readTiles(f):
+  # tiles are handed out as they are read, into a store of their own so calls don't overwrite each other's tiles
+  # and a long running caller doesn't keep the tiles of earlier reads alive
+  store = TileStore()
+  if TILE_READER == "mmap":
+    # reading edge codes out of the buffer is cheaper than sending the blocks to workers, so mapped tiles are prepared right here
+    buffer = mapTileFile(f)
+    tileBlocks = findMappedTileBlocks(buffer) if buffer is not None else []
+    if tileBlocks is not None:
+      return (Tile(tileBlock, prepareMappedTile(tileBlock), store) for tileBlock in tileBlocks)
+    # blocks of one fixed length are what makes the mapped reader quick, anything else is left to the lines reader
+    f.seek(0)
+  tileBlocks = readTileBlocks(f)
+  if WORKER_COUNT > 1:
+    return prepareTilesInParallel(tileBlocks, store)
+  return (Tile(tileBlock, store=store) for tileBlock in tileBlocks)
+
+def collectTiles(tileStream):
+  # returns (tiles, assembler), the incremental placer joins the tiles as they come in, for the others assembler is None
+  if TILE_PLACER == "incremental":
+    assembler = IncrementalAssembler()
+    for tile in tileStream:
+      assembler.addTile(tile)
+    return (assembler.tiles, assembler)
+  return (list(tileStream), None)
+
+def uncoverMap(tiles, assembler):
+  # tile explorer is the entity that is uncovering all tiles and setting the tile orientations
+  # tile navigator is the entity traversing the map of tiles once all orientations are set
+  if assembler is not None:
+    tilePlacer = assembler
+  else:
+    tilePlacer = TilePlacer(tiles) if TILE_PLACER == "constraint" else TileExplorer(tiles)
+  print(f"uncovering map with {type(tilePlacer).__name__}")
+  orientedTileMap = tilePlacer.uncoverMap()
+  print(f"finished uncovering map with {type(tilePlacer).__name__}")
+  return orientedTileMap
+
+def buildSearchMap(mapBuilder):
+  # the bitmask search works on a BitImage, the scan on the map as lines of text
+  if MONSTER_SEARCH == "bitmask":
+    return mapBuilder.buildImage()
+  return mapBuilder.buildMap()
+
+def getSearchMapLines(searchMap):
+  if MONSTER_SEARCH == "bitmask":
+    return searchMap.toLines()
+  return searchMap
+
+def markMonsters(searchMap):
+  # marks every monster in place and returns the harshness of what is left
+  if MONSTER_SEARCH == "bitmask":
+    ImageMonsterFinder(searchMap, search_templates).findMonsters()
+    return searchMap.getRoughness()
+
+  monsterFinder = MonsterFinder(searchMap)
+  monsterFinder.findMonsters()
+  allCharacters = ""
+  for line in monsterFinder.map:
+    allCharacters += line
+  return len(allCharacters.replace(".","").replace("O",""))
+
+def main():
+  if COLLECT_STATS:
+    enableStats()
+  with open("input.txt", "r") as f:
+    # tiles are only read as the stream gets consumed, so for the incremental placer this phase covers joining them too
+    with stats.phase("read tiles"):
+      (tiles, assembler) = collectTiles(readTiles(f))
+
+  with stats.phase("assemble map"):
+    orientedTileMap = uncoverMap(tiles, assembler)
 
-# tile explorer is the entity that is uncovering all tiles and setting the tile orientations
-# tile navigator is the entity traversing the map of tiles once all orientations are set
-print("uncovering map with TileExplorer")
-tileExplorer = TileExplorer(tiles)
-orientedTileMap = tileExplorer.uncoverMap()
-print("finished uncovering map with TileExplorer")
+  mapBuilder = MapBuilder(orientedTileMap)
+  mapBuilder.printTileGrid()
 
-mapBuilder = MapBuilder(orientedTileMap)
-mapBuilder.printTileGrid()
+  with stats.phase("build map"):
+    searchMap = buildSearchMap(mapBuilder)
+  print("")
+  mapBuilder.printLines(getSearchMapLines(searchMap))
 
-map = mapBuilder.buildMap()
-print("")
-mapBuilder.printLines(map)
+  with stats.phase("find monsters"):
+    harshness = markMonsters(searchMap)
 
-monsterFinder = MonsterFinder(map)
-monsterFinder.findMonsters()
+  print("")
+  print("marked map:")
+  print("")
+  mapBuilder.printLines(getSearchMapLines(searchMap))
 
-markedMap = monsterFinder.map
-print("")
-print("marked map:")
-print("")
-mapBuilder.printLines(markedMap)
+  print(f"harshness: {harshness}")
 
-allCharacters = ""
-for line in markedMap:
-  allCharacters += line
+  if COLLECT_STATS:
+    stats.write(STATS_FILE)
 
-harshness = len(allCharacters.replace(".","").replace("O",""))
-print(f"harshness: {harshness}")
\ No newline at end of file
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,345 @@
+#!/bin/python3
+
+# every case draws its input from random.Random(SEED + case number), so the same settings always produce the same inputs
+SEED = 2020
+# each case runs this many times, every run ends up in the output
+REPEATS = 3
+# one JSON object per line and run of a case
+OUTPUT_FILE = "bench_output.txt"
+# flag lines rewritten in a solution before it runs, values are python source,
+# setting "COLLECT_STATS": "True" adds the solution's call counters to every run (and slows the hot paths down)
+FLAG_OVERRIDES = {
+  "19_1": {"USE_GRAMMAR_CACHE": "False"},
+  "19_2": {"USE_GRAMMAR_CACHE": "False"},
+  "20_1": {},
+  "20_2": {}
+}
+
+# depth counts rule levels from rule 0 down to the literals, branching is the length of every option,
+# alternatives the number of options per rule, width the number of rules per level, recursion the number of self recursive rules
+# and leftRecursion how many of those refer to themselves first
+DAY19_CASES = [
+  {"depth": 4, "branching": 2, "alternatives": 2, "width": 4, "recursion": 0, "leftRecursion": 0, "messageCount": 2000, "matchRatio": 0.5},
+  {"depth": 5, "branching": 2, "alternatives": 2, "width": 6, "recursion": 2, "leftRecursion": 0, "messageCount": 2000, "matchRatio": 0.5},
+  {"depth": 6, "branching": 2, "alternatives": 2, "width": 8, "recursion": 0, "leftRecursion": 0, "messageCount": 2000, "matchRatio": 0.5},
+  {"depth": 5, "branching": 2, "alternatives": 2, "width": 6, "recursion": 2, "leftRecursion": 2, "messageCount": 2000, "matchRatio": 0.5}
+]
+# day 19 results are checked against this matcher of 19_2, which takes any grammar as it is
+REFERENCE_MATCHER = "earley"
+# tiles of a rows x columns map, density is the share of '#' cells that are not part of a sea monster
+DAY20_CASES = [
+  {"rows": 12, "columns": 12, "tileSize": 10, "density": 0.35, "monsterCount": 20},
+  {"rows": 24, "columns": 24, "tileSize": 12, "density": 0.35, "monsterCount": 80},
+  {"rows": 20, "columns": 50, "tileSize": 16, "density": 0.35, "monsterCount": 150}
+]
+
+import contextlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import types
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+sea_monster = [
+  "                  # ",
+  "#    ##    ##    ###",
+  " #  #  #  #  #  #   "
+]
+
+def generateGrammar(generator, depth, branching, alternatives, width, recursion, leftRecursion):
+  # rules are built bottom up, every rule only refers to rules of the level below it (or to itself)
+  if depth < 2 and recursion > 0:
+    raise RuntimeError("self recursive rules need a depth of at least 2")
+  if leftRecursion > recursion:
+    raise RuntimeError("left recursive rules are counted among the self recursive ones")
+  rules = {}
+  levelRules = []
+  for literal in "ab":
+    ruleName = str(len(rules) + 1)
+    rules[ruleName] = f"\"{literal}\""
+    levelRules.append(ruleName)
+
+  levels = list(range(depth - 1, 0, -1))
+  for level in levels:
+    newLevelRules = []
+    for _ in range(width):
+      ruleName = str(len(rules) + 1)
+      options = [" ".join(generator.choice(levelRules) for _ in range(branching)) for _ in range(alternatives)]
+      rules[ruleName] = " | ".join(options)
+      newLevelRules.append(ruleName)
+
+    # recursive rules have the same shapes as the ones the puzzle swaps in, "x | x r" and "x y | x r y",
+    # left recursive ones are turned around into "x | r x" and "x y | r x y"
+    for _ in range(recursion // len(levels) + (1 if levels.index(level) < recursion % len(levels) else 0)):
+      ruleName = str(len(rules) + 1)
+      (first, second) = (generator.choice(newLevelRules), generator.choice(newLevelRules))
+      isLeftRecursive = leftRecursion > 0
+      leftRecursion -= 1
+      if generator.random() < 0.5:
+        rules[ruleName] = f"{first} | {ruleName} {first}" if isLeftRecursive else f"{first} | {first} {ruleName}"
+      else:
+        rules[ruleName] = f"{first} {second} | {ruleName} {first} {second}" if isLeftRecursive else f"{first} {second} | {first} {ruleName} {second}"
+      newLevelRules.append(ruleName)
+    levelRules = newLevelRules
+
+  rules["0"] = " ".join(generator.choice(levelRules) for _ in range(branching))
+  return rules
+
+def deriveMessage(generator, rules, ruleName, recursionBudget):
+  definition = rules[ruleName]
+  if definition.startswith("\""):
+    return definition[1]
+  options = [option.split() for option in definition.split(" | ")]
+  # a rule referring to itself unrolls at most recursionBudget[0] more times for the whole message
+  recursiveOptions = [option for option in options if ruleName in option]
+  if recursiveOptions and recursionBudget[0] > 0 and generator.random() < 0.5:
+    recursionBudget[0] -= 1
+    option = generator.choice(recursiveOptions)
+  else:
+    option = generator.choice([option for option in options if ruleName not in option])
+  return "".join(deriveMessage(generator, rules, reference, recursionBudget) for reference in option)
+
+def generateDay19Input(generator, depth, branching, alternatives, width, recursion, leftRecursion, messageCount, matchRatio):
+  rules = generateGrammar(generator, depth, branching, alternatives, width, recursion, leftRecursion)
+  messages = []
+  for index in range(messageCount):
+    message = deriveMessage(generator, rules, "0", [recursion * 2])
+    # flipping a single character usually takes the message out of the language, but not always
+    if index >= messageCount * matchRatio:
+      position = generator.randrange(len(message))
+      message = message[:position] + ("b" if message[position] == "a" else "a") + message[position + 1:]
+    messages.append(message)
+  generator.shuffle(messages)
+
+  ruleNames = list(rules)
+  generator.shuffle(ruleNames)
+  lines = [f"{ruleName}: {rules[ruleName]}" for ruleName in ruleNames] + [""] + messages
+  # flipped messages can't be told apart from matching ones here, the reference matcher counts them later
+  return ("\n".join(lines) + "\n", None)
+
+def transformGrid(grid, quarterTurns, flipped):
+  for _ in range(quarterTurns):
+    grid = ["".join(row[column] for row in reversed(grid)) for column in range(len(grid[0]))]
+  if flipped:
+    grid = grid[::-1]
+  return grid
+
+def generateEdge(generator, first, last, length, usedEdges):
+  # edges get redrawn until no other edge reads the same either way, so corners and neighbours stay unambiguous
+  for _ in range(1000):
+    edge = first + "".join(generator.choice(".#") for _ in range(length - 2)) + last
+    if edge not in usedEdges and edge[::-1] not in usedEdges:
+      usedEdges.add(edge)
+      return edge
+  raise RuntimeError(f"ran out of unique edges, tiles of size {length} are too small for this map")
+
+def generateDay20Input(generator, rows, columns, tileSize, density, monsterCount):
+  interiorSize = tileSize - 2
+  image = [["#" if generator.random() < density else "." for _ in range(columns * interiorSize)] for _ in range(rows * interiorSize)]
+
+  # monsters never overlap each other, so each one takes exactly its own cells off the roughness
+  monsterCells = [(y, x) for (y, line) in enumerate(sea_monster) for (x, character) in enumerate(line) if character == "#"]
+  takenCells = set()
+  stampedMonsters = set()
+  stampedCells = set()
+  placedMonsters = 0
+  for _ in range(monsterCount * 20):
+    if placedMonsters == monsterCount:
+      break
+    top = generator.randrange(len(image) - len(sea_monster) + 1)
+    left = generator.randrange(len(image[0]) - len(sea_monster[0]) + 1)
+    cells = {(top + y, left + x) for y in range(len(sea_monster)) for x in range(len(sea_monster[0]))}
+    if cells & takenCells:
+      continue
+    takenCells |= cells
+    for (y, x) in monsterCells:
+      image[top + y][left + x] = "#"
+    placedMonsters += 1
+    stampedMonsters.add((top, left))
+    stampedCells |= {(top + y, left + x) for (y, x) in monsterCells}
+
+  # random cells (or parts of stamped monsters) can line up as monsters in any orientation, those lose a cell of their own
+  for variant in [transformGrid(sea_monster, quarterTurns, flipped) for flipped in [False, True] for quarterTurns in range(4)]:
+    variantCells = [(y, x) for (y, line) in enumerate(variant) for (x, character) in enumerate(line) if character == "#"]
+    for top in range(len(image) - len(variant) + 1):
+      for left in range(len(image[0]) - len(variant[0]) + 1):
+        if variant == sea_monster and (top, left) in stampedMonsters:
+          continue
+        if all(image[top + y][left + x] == "#" for (y, x) in variantCells):
+          (y, x) = generator.choice([(top + y, left + x) for (y, x) in variantCells if (top + y, left + x) not in stampedCells])
+          image[y][x] = "."
+  roughness = sum(row.count("#") for row in image) - placedMonsters * len(monsterCells)
+
+  # neighbouring tiles share their corners and edges
+  corners = [[generator.choice(".#") for _ in range(columns + 1)] for _ in range(rows + 1)]
+  usedEdges = set()
+  horizontalEdges = [[generateEdge(generator, corners[row][column], corners[row][column + 1], tileSize, usedEdges) for column in range(columns)] for row in range(rows + 1)]
+  verticalEdges = [[generateEdge(generator, corners[row][column], corners[row + 1][column], tileSize, usedEdges) for column in range(columns + 1)] for row in range(rows)]
+
+  titleWidth = max(4, len(str(rows * columns * 2)))
+  titles = generator.sample(range(10 ** (titleWidth - 1), 10 ** titleWidth), rows * columns)
+  tileBlocks = []
+  for row in range(rows):
+    for column in range(columns):
+      grid = [horizontalEdges[row][column]]
+      for y in range(interiorSize):
+        interior = "".join(image[row * interiorSize + y][column * interiorSize:(column + 1) * interiorSize])
+        grid.append(verticalEdges[row][column][y + 1] + interior + verticalEdges[row][column + 1][y + 1])
+      grid.append(horizontalEdges[row + 1][column])
+      grid = transformGrid(grid, generator.randrange(4), generator.random() < 0.5)
+      tileBlocks.append("\n".join([f"Tile {titles[row * columns + column]}:"] + grid) + "\n")
+  generator.shuffle(tileBlocks)
+
+  cornerProduct = titles[0] * titles[columns - 1] * titles[(rows - 1) * columns] * titles[-1]
+  return ("\n".join(tileBlocks) + "\n", {"20_1": cornerProduct, "20_2": roughness})
+
+def loadSolution(name, flagOverrides, moduleName=None):
+  # the flag lines are rewritten before the solution runs, its driver only starts when it runs as a script
+  path = os.path.join(REPOSITORY_DIRECTORY, name, "solution.py")
+  with open(path, "r") as sourceFile:
+    source = sourceFile.read()
+  for (flag, value) in flagOverrides.items():
+    (source, replacements) = re.subn(rf"^{flag} = .*$", f"{flag} = {value}", source, count=1, flags=re.MULTILINE)
+    if replacements == 0:
+      raise RuntimeError(f"{name} has no flag {flag}")
+  solution = types.ModuleType(moduleName if moduleName is not None else f"solution_{name}")
+  solution.__file__ = path
+  # worker processes look functions up by module name
+  sys.modules[solution.__name__] = solution
+  exec(compile(source, path, "exec"), solution.__dict__)
+  return solution
+
+def runDay19(solution, inputPath):
+  phaseTimes = {}
+  start = time.perf_counter()
+  with open(inputPath, "r") as f:
+    grammarLines = solution.readGrammarLines(f)
+    testLines = list(solution.readTestLines(f))
+  if solution.WORKER_COUNT > 1:
+    # every worker builds its own grammar, which then counts towards matching
+    phaseTimes["parse"] = time.perf_counter() - start
+    start = time.perf_counter()
+    lineResults = solution.matchLinesInParallel(testLines, grammarLines)
+  else:
+    (grammarDictionary, compiledGrammar) = solution.loadGrammar(grammarLines)
+    phaseTimes["parse"] = time.perf_counter() - start
+    start = time.perf_counter()
+    lineResults = solution.matchLinesInSequence(testLines, grammarDictionary, compiledGrammar)
+  count = sum(1 for (testLine, doesMatch) in lineResults if doesMatch)
+  phaseTimes["match"] = time.perf_counter() - start
+  return (phaseTimes, count)
+
+def countReferenceMatches(inputPath):
+  global reference_solution
+  if reference_solution is None:
+    reference_solution = loadSolution("19_2", {"MATCHER": repr(REFERENCE_MATCHER), "WORKER_COUNT": "1", "USE_GRAMMAR_CACHE": "False"}, "reference_19_2")
+    reference_solution.RULE_OVERRIDES = {}
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    (phaseTimes, count) = runDay19(reference_solution, inputPath)
+  return count
+
+def readTiles(solution, inputPath):
+  with open(inputPath, "r") as f:
+    return list(solution.readTiles(f))
+
+def runDay20Corners(solution, inputPath):
+  phaseTimes = {}
+  start = time.perf_counter()
+  tiles = readTiles(solution, inputPath)
+  phaseTimes["parse"] = time.perf_counter() - start
+
+  # the incremental placer joins the tiles here instead of while reading them, so that counts towards assembly
+  start = time.perf_counter()
+  (corners, orientedTileMap) = solution.findCorners(*solution.collectTiles(tiles))
+  phaseTimes["assembly"] = time.perf_counter() - start
+
+  cornerProduct = 1
+  for corner in corners:
+    cornerProduct *= corner.title
+  return (phaseTimes, cornerProduct)
+
+def runDay20Monsters(solution, inputPath):
+  phaseTimes = {}
+  start = time.perf_counter()
+  tiles = readTiles(solution, inputPath)
+  phaseTimes["parse"] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  orientedTileMap = solution.uncoverMap(*solution.collectTiles(tiles))
+  phaseTimes["assembly"] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  searchMap = solution.buildSearchMap(solution.MapBuilder(orientedTileMap))
+  roughness = solution.markMonsters(searchMap)
+  phaseTimes["match"] = time.perf_counter() - start
+  return (phaseTimes, roughness)
+
+reference_solution = None
+
+benchmarks = {
+  "19_1": (DAY19_CASES, generateDay19Input, runDay19),
+  "19_2": (DAY19_CASES, generateDay19Input, runDay19),
+  "20_1": (DAY20_CASES, generateDay20Input, runDay20Corners),
+  "20_2": (DAY20_CASES, generateDay20Input, runDay20Monsters)
+}
+
+solutionNames = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks)
+with open(OUTPUT_FILE, "w") as outputFile, tempfile.TemporaryDirectory() as inputDirectory:
+  for solutionName in solutionNames:
+    (cases, generateInput, runSolution) = benchmarks[solutionName]
+    solution = loadSolution(solutionName, FLAG_OVERRIDES[solutionName])
+    if solution.COLLECT_STATS:
+      # only main() turns the counting wrappers on by itself
+      solution.enableStats()
+    for (caseNumber, case) in enumerate(cases):
+      if solutionName == "19_1" and case.get("recursion", 0) > 0:
+        # the first part of the puzzle has no rule overrides, its matchers aren't built for self recursive rules
+        print(f"{solutionName} case {caseNumber}: skipped, self recursive rules are only part of 19_2")
+        continue
+      (inputText, expectedResults) = generateInput(random.Random(SEED + caseNumber), **case)
+      inputPath = os.path.join(inputDirectory, f"input-{solutionName}-{caseNumber}.txt")
+      with open(inputPath, "w") as inputFile:
+        inputFile.write(inputText)
+      if solutionName == "19_2":
+        # generated grammars bring their own recursive rules, the puzzle's overrides would clobber unrelated rules
+        solution.RULE_OVERRIDES = {}
+      if expectedResults is None:
+        expectedResults = {solutionName: countReferenceMatches(inputPath)}
+
+      for run in range(REPEATS):
+        solution.stats.reset()
+        # the solutions report their progress as they go, which would only drown the numbers here
+        error = None
+        try:
+          with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            (phaseTimes, result) = runSolution(solution, inputPath)
+        except Exception as exception:
+          # a placer giving up on a generated map is a result as well, the other cases still run
+          (phaseTimes, result) = ({}, None)
+          error = f"{type(exception).__name__}: {exception}"
+        expectedResult = expectedResults[solutionName] if expectedResults is not None else None
+        record = {
+          "solution": solutionName,
+          "case": caseNumber,
+          "parameters": case,
+          "flags": FLAG_OVERRIDES[solutionName],
+          "run": run,
+          "phases": phaseTimes,
+          "result": result,
+          "expected": expectedResult,
+          "error": error,
+          "counters": solution.stats.toDict()["counters"] if solution.COLLECT_STATS else None
+        }
+        outputFile.write(json.dumps(record) + "\n")
+        outputFile.flush()
+        if error is not None:
+          print(f"{solutionName} case {caseNumber} run {run}: failed with {error}")
+          continue
+        phaseReport = ", ".join(f"{phase} {seconds:.4f}s" for (phase, seconds) in phaseTimes.items())
+        mismatch = "" if expectedResult is None or expectedResult == result else f" (expected {expectedResult})"
+        print(f"{solutionName} case {caseNumber} run {run}: {phaseReport}, result {result}{mismatch}")